@@ -4,14 +4,15 @@
 # dependencies: pyzmail python-magic Pillow
 # WARNING: python2.x incompatible
 
-# TODO: split large file
 # TODO: gui
 
 
 import pyzmail
 from pyzmail import compose_mail
-from glob import glob
-import os, io, hashlib, functools, html, datetime, base64, json
+import os, io, hashlib, functools, html, datetime, base64, json, re, fnmatch, math, string, csv
+import concurrent.futures, sqlite3, threading, time, smtplib, socket, uuid, tempfile, zipfile, tarfile
+import collections, collections.abc, bisect, queue, argparse, getpass, sys, mimetypes, copy
+import email.policy, email.utils
 
 
 """
@@ -19,6 +20,8 @@ This module contains utilities to sending photos, files by email.
 
 usage:
 images = glob('*.JPG')
+# or walk a directory tree, each file is stat()'ed once
+images = find_files('photos', include=['*.JPG'])
 # sort and split images into groups
 grps = files2groups(images, max_size=10*1024*1024, ordered_by='image.date')
 # setup each Email instance
@@ -32,6 +35,9 @@ for eml in emls:
     # send the email
     eml.send()
 
+command line, the first emails are sent while later files are still scanned:
+python batchmail.py --from xxx@example.com --to yyy@abc.com --smtp smtp.example.com:587 \
+    --max-size 10 --cache ~/.batchmail.sqlite --journal photos.journal photos/
 """
 
 
@@ -62,6 +68,705 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+class FileEntry(str):
+    """a file name carrying the stat result taken when the file was found
+    
+    it is a str, so it can be used wherever a file name is expected,
+    file_stat() returns the carried stat result instead of calling os.stat().
+    """
+    def __new__(cls, path, stat_result=None):
+        self = super().__new__(cls, path)
+        self.stat_result = stat_result
+        return self
+
+def file_stat(file_name):
+    """return the stat result of a file, reusing the one of a FileEntry"""
+    st = getattr(file_name, 'stat_result', None)
+    if st is None:
+        st = os.stat(file_name)
+    return st
+
+def find_files(paths, include=None, exclude=None, recursive=True, follow_symlinks=False):
+    """find files with os.scandir(), return a list of FileEntry, see iter_files()"""
+    return list(iter_files(paths, include, exclude, recursive, follow_symlinks))
+
+def iter_files(paths, include=None, exclude=None, recursive=True, follow_symlinks=False):
+    """find files with os.scandir(), yield FileEntry as they are found
+    
+    paths: a directory, a file, or a list of them.
+    include: list of fnmatch patterns matched against file names, None for all files.
+    exclude: list of fnmatch patterns, matching files and directories are skipped.
+    
+    each file is stat()'ed once, the result is passed on to sorting,
+    grouping and meta data extraction.
+    
+    eg:
+    images = find_files('photos', include=['*.JPG', '*.jpg'], exclude=['.*'])
+    grps = files2groups(images, ordered_by='image.date')
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    include = include or ['*']
+    exclude = exclude or []
+    
+    def match(name, patterns):
+        return any(fnmatch.fnmatch(name, x) for x in patterns)
+    
+    def walk(directory):
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda x: x.name)
+        for entry in entries:
+            if match(entry.name, exclude):
+                continue
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                if recursive:
+                    yield from walk(entry.path)
+            elif entry.is_file(follow_symlinks=follow_symlinks) and match(entry.name, include):
+                yield FileEntry(entry.path, entry.stat(follow_symlinks=follow_symlinks))
+    
+    for path in paths:
+        if os.path.isdir(path):
+            yield from walk(path)
+        else:
+            yield FileEntry(path, os.stat(path))
+
+
+class Metrics:
+    """instrumentation of the pipeline, an event stream and aggregate counters
+    
+    pass it as metrics= to files2meta_data_list(), files2groups(), meta_data2groups(),
+    groups2Emails(), send_emails(), send_groups(), send_grouped_files() or SMTPPool.
+    each event is a dict with 'event', 'time' and the fields below, passed to on_event:
+    'file'          path, size, cached, error, seconds, read_time, hash_time, magic_time, image_time
+    'group'         index, files, bytes (attachments), size (as packed, see WireSizeEstimator)
+    'render'        index, seconds, html_bytes, text_bytes
+    'body'          bytes, seconds (a body built once by Email.fanout())
+    'message'       index, ok, account, error, attempts, bytes, generate_time, wait_time, send_time
+    'smtp_connect'  host, port, connect_time (tcp, ehlo, starttls), auth_time
+    'smtp_data'     host, port, bytes, seconds (MAIL to the final reply)
+    the counters are the number of each event and the sums of its numeric fields,
+    eg: counters['file']['hash_time'] is the seconds spent hashing.
+    
+    usage:
+    metrics = Metrics(on_event=lambda e: print(e['event'], e.get('seconds')))
+    grps = files2groups(glob('*.JPG'), workers=4, metrics=metrics)
+    send_groups(grps, ..., metrics=metrics)
+    open('batchmail.prom', 'w').write(metrics.to_prometheus())
+    """
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # event -> {'count': n, field: sum}
+        self.counters = {}
+    
+    def emit(self, event, **fields):
+        """record an event, called by the instrumented functions"""
+        fields['event'] = event
+        fields['time'] = time.time()
+        with self._lock:
+            counter = self.counters.setdefault(event, {'count': 0})
+            counter['count'] += 1
+            for k, v in fields.items():
+                if isinstance(v, (int, float)) and k not in ('time', 'index', 'port'):
+                    counter[k] = counter.get(k, 0) + v
+        if self.on_event is not None:
+            self.on_event(fields)
+    
+    def snapshot(self):
+        """return a copy of the counters"""
+        with self._lock:
+            return { k: dict(v) for k, v in self.counters.items() }
+    
+    def to_json(self, **kwd):
+        return json_encode({
+            'started'   : self.started,
+            'elapsed'   : time.time() - self.started,
+            'counters'  : self.snapshot(),
+        }, **kwd)
+    
+    def to_prometheus(self, prefix='batchmail_'):
+        """return the counters in the Prometheus text exposition format
+        
+        eg: batchmail_file_total 120, batchmail_file_hash_seconds_total 3.2
+        """
+        lines = []
+        for event, counter in sorted(self.snapshot().items()):
+            for k, v in sorted(counter.items()):
+                if k == 'count':
+                    name = '%s%s_total' % (prefix, event)
+                else:
+                    if k.endswith('_time'):
+                        k = k[:-len('_time')] + '_seconds'
+                    name = '%s%s_%s_total' % (prefix, event, k)
+                lines.append('# TYPE %s counter' % name)
+                lines.append('%s %s' % (name, repr(float(v)) if isinstance(v, float) else int(v)))
+        return '\n'.join(lines) + '\n'
+
+
+class TypeDetector:
+    """type detection of files, shared by get_meta_data() and Email
+    
+    one magic.Magic handle for the mime type and one for the description are
+    opened on first use and kept, only the first head_size bytes of a file are
+    classified. the results are cached by file identity (path, size, mtime_ns,
+    inode), up to max_entries. without python-magic, the mime type is guessed
+    from the file extension and the description is None.
+    
+    usage:
+    mime_type, description = type_detector().detect('a.jpg')
+    """
+    def __init__(self, head_size=8*1024, max_entries=64*1024):
+        self.head_size = head_size
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # a handle is not thread safe
+        self._lock = threading.Lock()
+        # (mime handle, description handle), False if python-magic is missing
+        self._magic = None
+        self._cache = collections.OrderedDict()
+    
+    def _handles(self):
+        if self._magic is None:
+            try:
+                import magic
+                self._magic = (magic.Magic(mime=True), magic.Magic())
+            except ImportError:
+                self._magic = False
+        return self._magic
+    
+    def detect_buffer(self, data, file_name=None):
+        """return (mime type, description) of the head of a file
+        
+        file_name is for the extension fallback, when python-magic is missing
+        or gives no mime type.
+        """
+        mime_type = description = None
+        handles = self._handles()
+        if handles:
+            data = bytes(data[:self.head_size])
+            with self._lock:
+                mime_type = handles[0].from_buffer(data)
+                description = handles[1].from_buffer(data)
+            # old versions of python-magic return bytes
+            if isinstance(mime_type, bytes):
+                mime_type = mime_type.decode('UTF-8')
+            if isinstance(description, bytes):
+                description = description.decode('UTF-8')
+        if not mime_type and file_name is not None:
+            mime_type = mimetypes.guess_type(os.fspath(file_name), strict=False)[0]
+        return mime_type, description
+    
+    def detect(self, file_name, head=None, st=None):
+        """return (mime type, description) of a file, cached by the file identity
+        
+        head is the data already read from the start of the file, if any.
+        """
+        if st is None:
+            st = file_stat(file_name)
+        key = (os.path.abspath(file_name), st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._lock:
+            ret = self._cache.get(key)
+            if ret is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return ret
+            self.misses += 1
+        if head is None or (len(head) < self.head_size and len(head) < st.st_size):
+            with open(file_name, 'rb') as f:
+                head = f.read(self.head_size)
+        ret = self.detect_buffer(head, file_name)
+        with self._lock:
+            self._cache[key] = ret
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return ret
+
+_type_detector = None
+
+def type_detector():
+    """return the TypeDetector of this process, eg: of a worker of files2meta_data_list()"""
+    global _type_detector
+    if _type_detector is None:
+        _type_detector = TypeDetector()
+    return _type_detector
+
+
+# size of the blocks read and written by the streaming message writer
+STREAM_CHUNK_SIZE = 57*1024*4     # base64 encodes 57 bytes into a 76 chars line
+
+
+class SMTPSession:
+    """a reusable smtp connection
+    
+    the connection is opened on the first sendmail() and kept open,
+    it is reopened after max_messages messages, on a 421 reply or a timeout,
+    and checked with NOOP before a message when idle longer than keepalive seconds.
+    
+    usage:
+    sess = SMTPSession('smtp.example.com', 587, 'tls', 'xxx@example.com', '*****')
+    sess.sendmail(payload, 'xxx@example.com', ['yyy@abc.com'])
+    sess.close()
+    """
+    def __init__(self, host, port=25, mode='normal', user_name=None, password=None,
+                 timeout=60, max_messages=100, keepalive=30, metrics=None):
+        self.host = host
+        self.port = port
+        # 'normal', 'ssl' or 'tls'
+        self.mode = mode
+        self.user_name = user_name
+        self.password = password
+        self.timeout = timeout
+        # messages sent on one connection before reconnecting, None for unlimited
+        self.max_messages = max_messages
+        # idle seconds before a NOOP check
+        self.keepalive = keepalive
+        # Metrics for 'smtp_connect' and 'smtp_data' events
+        self.metrics = metrics
+        
+        self._smtp = None
+        self._sent = 0
+        self._last_used = 0
+    
+    @property
+    def key(self):
+        return (self.host, self.port, self.mode, self.user_name)
+    
+    def connect(self):
+        self.close()
+        t0 = time.perf_counter()
+        if self.mode == 'ssl':
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if self.mode == 'tls':
+                smtp.starttls()
+                smtp.ehlo()
+            t1 = time.perf_counter()
+            if self.user_name is not None:
+                smtp.login(self.user_name, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        if self.metrics is not None:
+            self.metrics.emit('smtp_connect', host=self.host, port=self.port,
+                              connect_time=t1 - t0, auth_time=time.perf_counter() - t1)
+        self._smtp = smtp
+        self._sent = 0
+        self._last_used = time.monotonic()
+    
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+    
+    def is_connected(self):
+        return self._smtp is not None
+    
+    def _check(self):
+        """make sure there is a usable connection"""
+        if self._smtp is not None and self.max_messages is not None and self._sent >= self.max_messages:
+            self.close()
+        if self._smtp is not None and time.monotonic() - self._last_used > self.keepalive:
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+                self._smtp = None
+        if self._smtp is None:
+            self.connect()
+    
+    @staticmethod
+    def _is_transient(e):
+        """whether a fresh connection may succeed"""
+        if isinstance(e, smtplib.SMTPResponseException):
+            return e.smtp_code == 421
+        return isinstance(e, (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError))
+    
+    def sendmail(self, payload, from_addr, to_addrs):
+        """send a message, return a dict of refused recipients like smtplib.SMTP.sendmail()
+        
+        smtplib exceptions are raised, a transient error is retried once on a new connection.
+        """
+        for retry in (True, False):
+            self._check()
+            try:
+                t0 = time.perf_counter()
+                ret = self._smtp.sendmail(from_addr, to_addrs, payload)
+                if self.metrics is not None:
+                    self.metrics.emit('smtp_data', host=self.host, port=self.port, bytes=len(payload),
+                                      seconds=time.perf_counter() - t0)
+            except Exception as e:
+                if not SMTPSession._is_transient(e):
+                    raise
+                self._smtp.close()
+                self._smtp = None
+                if not retry:
+                    raise
+            else:
+                self._sent += 1
+                self._last_used = time.monotonic()
+                return ret
+    
+    def sendmail_chunks(self, make_chunks, from_addr, to_addrs):
+        """send a message streamed from make_chunks(), return a dict of refused recipients
+        
+        make_chunks is called (again on a retry) to get an iterable of bytes with
+        CRLF line endings, each chunk must end at a line end. BDAT is used if the
+        server supports CHUNKING, otherwise DATA.
+        """
+        for retry in (True, False):
+            self._check()
+            try:
+                ret = self._transfer(make_chunks(), from_addr, to_addrs)
+            except Exception as e:
+                if not SMTPSession._is_transient(e):
+                    raise
+                if self._smtp is not None:
+                    self._smtp.close()
+                    self._smtp = None
+                if not retry:
+                    raise
+            else:
+                self._sent += 1
+                self._last_used = time.monotonic()
+                return ret
+    
+    def _transfer(self, chunks, from_addr, to_addrs, buffer_size=STREAM_CHUNK_SIZE):
+        """send a message, on any error the connection is dropped unless it was reset"""
+        smtp = self._smtp
+        # the refusals raised after a successful RSET, the connection is then usable
+        reset = []
+        def refuse(exc):
+            smtp.rset()
+            reset.append(exc)
+            return exc
+        
+        try:
+            return self._transfer_chunks(smtp, refuse, chunks, from_addr, to_addrs, buffer_size)
+        except BaseException as e:
+            if not any(e is x for x in reset):
+                # eg: an attachment failed to be read in the middle of DATA
+                self._smtp = None
+                smtp.close()
+            raise
+    
+    def _transfer_chunks(self, smtp, refuse, chunks, from_addr, to_addrs, buffer_size):
+        t0 = time.perf_counter()
+        sent = 0
+        code, resp = smtp.mail(from_addr)
+        if code != 250:
+            raise refuse(smtplib.SMTPSenderRefused(code, resp, from_addr))
+        refused = {}
+        for addr in to_addrs:
+            code, resp = smtp.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            raise refuse(smtplib.SMTPRecipientsRefused(refused))
+        
+        def coalesced():
+            """merge small chunks up to buffer_size"""
+            buf = []
+            size = 0
+            for chunk in chunks:
+                buf.append(chunk)
+                size += len(chunk)
+                if size >= buffer_size:
+                    yield b''.join(buf)
+                    buf = []
+                    size = 0
+            if buf:
+                yield b''.join(buf)
+        
+        if smtp.does_esmtp and smtp.has_extn('chunking'):
+            for chunk in coalesced():
+                smtp.send(b'BDAT %d\r\n' % len(chunk))
+                smtp.send(chunk)
+                sent += len(chunk)
+                code, resp = smtp.getreply()
+                if code != 250:
+                    raise refuse(smtplib.SMTPDataError(code, resp))
+            smtp.send(b'BDAT 0 LAST\r\n')
+        else:
+            code, resp = smtp.docmd('data')
+            if code != 354:
+                raise refuse(smtplib.SMTPDataError(code, resp))
+            line_start = True
+            for chunk in coalesced():
+                # dot-stuffing
+                if line_start and chunk.startswith(b'.'):
+                    chunk = b'.' + chunk
+                chunk = chunk.replace(b'\r\n.', b'\r\n..')
+                smtp.send(chunk)
+                sent += len(chunk)
+                line_start = chunk.endswith(b'\r\n')
+            smtp.send(b'.\r\n' if line_start else b'\r\n.\r\n')
+        code, resp = smtp.getreply()
+        if code != 250:
+            raise refuse(smtplib.SMTPDataError(code, resp))
+        if self.metrics is not None:
+            self.metrics.emit('smtp_data', host=self.host, port=self.port, bytes=sent,
+                              seconds=time.perf_counter() - t0)
+        return refused
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+class SMTPPool:
+    """a pool of SMTPSession, keyed by (host, port, mode, user_name)
+    
+    a session is used by one sender at a time, idle sessions are kept for reuse.
+    
+    usage:
+    with SMTPPool() as pool:
+        for eml in groups2Emails(grps, title='Some photos', smtp_pool=pool, ...):
+            eml.send()
+    """
+    def __init__(self, timeout=60, max_messages=100, keepalive=30, metrics=None):
+        # options of new sessions
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.keepalive = keepalive
+        self.metrics = metrics
+        
+        self._lock = threading.Lock()
+        # key -> list of idle sessions
+        self._idle = {}
+    
+    def acquire(self, host, port=25, mode='normal', user_name=None, password=None):
+        """return a session for exclusive use, give it back by release()"""
+        with self._lock:
+            idle = self._idle.get((host, port, mode, user_name))
+            if idle:
+                sess = idle.pop()
+                sess.password = password
+                return sess
+        return SMTPSession(host, port, mode, user_name, password,
+                           self.timeout, self.max_messages, self.keepalive, self.metrics)
+    
+    def release(self, sess):
+        with self._lock:
+            self._idle.setdefault(sess.key, []).append(sess)
+    
+    def sendmail(self, payload, from_addr, to_addrs, host, port=25, mode='normal',
+                 user_name=None, password=None):
+        """send a message on a pooled session, see SMTPSession.sendmail()"""
+        sess = self.acquire(host, port, mode, user_name, password)
+        try:
+            return sess.sendmail(payload, from_addr, to_addrs)
+        finally:
+            self.release(sess)
+    
+    def sendmail_chunks(self, make_chunks, from_addr, to_addrs, host, port=25, mode='normal',
+                        user_name=None, password=None):
+        """stream a message on a pooled session, see SMTPSession.sendmail_chunks()"""
+        sess = self.acquire(host, port, mode, user_name, password)
+        try:
+            return sess.sendmail_chunks(make_chunks, from_addr, to_addrs)
+        finally:
+            self.release(sess)
+    
+    def close(self):
+        with self._lock:
+            sessions = [ x for idle in self._idle.values() for x in idle ]
+            self._idle = {}
+        for sess in sessions:
+            sess.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+def smtp_error_message(e, host=None, port=None):
+    """format a smtp exception as the error string returned by pyzmail.send_mail()"""
+    if isinstance(e, smtplib.SMTPAuthenticationError):
+        return 'authentication error: %s' % (e, )
+    elif isinstance(e, smtplib.SMTPRecipientsRefused):
+        return 'recipients refused: ' + ', '.join(e.recipients.keys())
+    elif isinstance(e, smtplib.SMTPSenderRefused):
+        return 'sender refused: %s' % (e.sender, )
+    elif isinstance(e, smtplib.SMTPDataError):
+        return 'SMTP protocol mismatch: %s' % (e, )
+    elif isinstance(e, smtplib.SMTPHeloError):
+        return 'server didn\'t reply properly to the HELO greeting: %s' % (e, )
+    elif isinstance(e, smtplib.SMTPException):
+        return 'SMTP error: %s' % (e, )
+    else:
+        return 'server %s:%s not responding: %s' % (host, port, e)
+
+
+def _mime_headers(*items):
+    """fold the (name, value) headers with a value, followed by the blank line"""
+    policy = email.policy.SMTP
+    return b''.join(policy.header_factory(k, v).fold(policy=policy).encode('ascii')
+                    for k, v in items if v) + b'\r\n'
+
+def _mime_boundary():
+    return '===============%s==' % uuid.uuid4().hex
+
+def _encode_b64(data):
+    # encodebytes() breaks lines every 76 chars
+    return base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+def _b64_chunk_size(chunk_size):
+    """round chunk_size down to whole lines of base64, so the encoded chunks can be joined"""
+    return max(57, chunk_size - chunk_size % 57)
+
+
+class EncodedBlockCache:
+    """bounded LRU cache of base64 encoded attachment blocks, shared by threads
+    
+    an attachment sent in several messages, eg: to several recipients, or
+    again after a failure, is read and encoded once while it is cached.
+    blocks are keyed by the file identity, a modified file is read again.
+    
+    max_bytes: max total size of the encoded blocks.
+    
+    eg:
+    cache = EncodedBlockCache(128*1024*1024)
+    for eml in emails:
+        eml.block_cache = cache
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._blocks = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            data = self._blocks.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+            return data
+    
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._blocks[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, old = self._blocks.popitem(last=False)
+                self._size -= len(old)
+    
+    @property
+    def size(self):
+        return self._size
+    
+    def iter_encoded(self, at, chunk_size=STREAM_CHUNK_SIZE):
+        """yield the base64 encoded content of an attachment in blocks of chunk_size bytes
+        
+        chunk_size is rounded down to a multiple of 57, so the lines are broken
+        as if the attachment was encoded in one piece.
+        """
+        chunk_size = _b64_chunk_size(chunk_size)
+        path, offset, size, _ = Email.attachment_range(at)
+        st = os.stat(path)
+        ident = (os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino)
+        end = st.st_size if size is None else min(st.st_size, offset + size)
+        f = None
+        try:
+            for pos in range(offset, end, chunk_size):
+                key = ident + (pos, min(chunk_size, end - pos))
+                data = self.get(key)
+                if data is None:
+                    if f is None:
+                        f = open(path, 'rb')
+                    f.seek(pos)
+                    data = _encode_b64(f.read(key[-1]))
+                    self.put(key, data)
+                yield data
+        finally:
+            if f is not None:
+                f.close()
+
+
+class MessageBody:
+    """a MIME body built once and sent under different headers, see Email.fanout()
+    
+    chunks: the body as an iterable of bytes, eg: Email.iter_body(), it is
+            written when the body is first used, so a body never sent is never built.
+    metrics: Metrics, a 'body' event is emitted when the body is built.
+    
+    the body is kept in memory up to max_memory bytes, in a temporary file
+    above. it can be read by several threads at a time.
+    """
+    def __init__(self, content_type, chunks=(), max_memory=STREAM_CHUNK_SIZE*16, metrics=None):
+        self.content_type = content_type
+        self.metrics = metrics
+        self._chunks = chunks
+        self._error = None
+        self._size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_memory)
+        self._lock = threading.Lock()
+    
+    def _build(self):
+        # with self._lock held
+        if self._error is not None:
+            raise self._error
+        if self._chunks is None:
+            return
+        t0 = time.perf_counter()
+        try:
+            for data in self._chunks:
+                self._file.write(data)
+                self._size += len(data)
+        except Exception as e:
+            self._error = e
+            raise
+        finally:
+            self._chunks = None
+        if self.metrics is not None:
+            self.metrics.emit('body', bytes=self._size, seconds=time.perf_counter() - t0)
+    
+    @property
+    def size(self):
+        with self._lock:
+            self._build()
+            return self._size
+    
+    def iter_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        pos = 0
+        while True:
+            with self._lock:
+                self._build()
+                self._file.seek(pos)
+                data = self._file.read(chunk_size)
+            if not data:
+                break
+            pos += len(data)
+            yield data
+    
+    def close(self):
+        with self._lock:
+            self._chunks = None
+            self._file.close()
+
+
 class Email:
     """simple high level interface to send an email
     
@@ -71,7 +776,8 @@ class Email:
     """
     def __init__(self, from_=None, to=[], cc=[], bcc=[],
                  subject='', text=None, html=None, attachments=[],
-                 smtp=None, user_name=None, password=None, mode='tls', **kwds):
+                 smtp=None, user_name=None, password=None, mode='tls', smtp_pool=None, embeddeds=[],
+                 block_cache=None, **kwds):
         self.from_ = from_
         # list of recipients
         self.to = to
@@ -86,6 +792,8 @@ class Email:
         
         # list of file names
         self.attachments = attachments
+        # list of inline parts referenced by cid: in html, (data, mime type, content id)
+        self.embeddeds = embeddeds
         
         # smtp server
         self.smtp = smtp
@@ -95,6 +803,12 @@ class Email:
         self.password = password
         # 'normal', 'ssl' or 'tls'
         self.mode = mode
+        # SMTPPool shared by emails, None to connect for each send()
+        self.smtp_pool = smtp_pool
+        # EncodedBlockCache shared by emails, None to encode the attachments for each message
+        self.block_cache = block_cache
+        # MessageBody shared by the copies made by fanout(), None to generate the body
+        self.body = None
     
     def __json__(self):
         """return a dict to be jsonized, used by JSONEncoder"""
@@ -181,250 +895,2347 @@ class Email:
             
     @staticmethod
     def get_mime_type(file_name):
-        try:
-            import magic
-            return magic.from_file(file_name, mime=True).decode('UTF-8')
-        except ImportError:
-            import mimetypes
-            return mimetypes.guess_type(file_name, strict=False)[0]
+        """return the mime type of a file by type_detector(), None if unknown"""
+        return type_detector().detect(file_name)[0]
 
+    @staticmethod
+    def attachment_range(at):
+        """return (path, offset, size, file name) of an attachment
+        
+        an attachment is a file name, or a dict for a range of a file:
+        {'path': ..., 'offset': ..., 'size': ..., 'name': ..., 'mime_type': ...}
+        offset is 0 and size is None (the rest of the file) if not given.
+        """
+        if isinstance(at, dict):
+            return (at['path'], at.get('offset', 0), at.get('size'),
+                    at.get('name') or os.path.normpath(at['path']).rsplit(os.sep, 1)[-1])
+        return at, 0, None, os.path.normpath(at).rsplit(os.sep, 1)[-1]
+    
+    @staticmethod
+    def attachment_size(at):
+        path, offset, size, _ = Email.attachment_range(at)
+        return size if size is not None else file_stat(path).st_size - offset
+    
+    @staticmethod
+    def attachment_mime_type(at):
+        if isinstance(at, dict):
+            # a part of a file if not given
+            return at.get('mime_type') or 'application/octet-stream'
+        return Email.get_mime_type(at) or 'application/octet-stream'
+    
+    @staticmethod
+    def read_attachment(at, chunk_size=STREAM_CHUNK_SIZE):
+        """yield the content of an attachment in chunks of chunk_size bytes"""
+        path, offset, size, _ = Email.attachment_range(at)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while size is None or size > 0:
+                data = f.read(chunk_size if size is None else min(chunk_size, size))
+                if not data:
+                    break
+                if size is not None:
+                    size -= len(data)
+                yield data
+    
     def make_attachments(self):
         result = []
         for at in self.attachments:
-            with open(at, 'rb') as f:
-                content = f.read()
-            mime_type = Email.get_mime_type(at)
+            content = b''.join(Email.read_attachment(at))
+            mime_type = Email.attachment_mime_type(at)
             m1, m2 = mime_type.split('/')
-            file_name = os.path.normpath(at).rsplit(os.sep, 1)[-1]
-            result.append((content, m1, m2, file_name, None))
+            file_name = Email.attachment_range(at)[3]
+            charset = None
+            if m1 == 'text':
+                # compose_mail() makes a MIMEText of a text part, which takes a str
+                try:
+                    content = content.decode('utf-8')
+                    charset = 'utf-8'
+                except UnicodeDecodeError:
+                    m1, m2 = 'application', 'octet-stream'
+            result.append((content, m1, m2, file_name, charset))
         return result
         
     def generate(self):
         self.normalize()
+        if self.body is not None or self.block_cache is not None:
+            return b''.join(self.iter_payload())
         got_attachments = self.make_attachments()
+        got_embeddeds = [ (data, ) + tuple(mime_type.split('/')) + (cid, None)
+                          for data, mime_type, cid in self.embeddeds ]
         return compose_mail(self.from_, self.to, self.subject, 'UTF-8',
-                            self.text, self.html, got_attachments, [], self.cc, self.bcc)[0]
+                            self.text, self.html, got_attachments, got_embeddeds, self.cc, self.bcc)[0]
     
-    def send(self, to=None):
+    def iter_payload(self, chunk_size=STREAM_CHUNK_SIZE):
+        """generate the message as chunks of bytes with CRLF line endings
+        
+        attachments are read and base64 encoded chunk_size bytes at a time,
+        so the memory used does not grow with the size of the message.
+        the encoded attachments are taken from self.block_cache if set, and
+        the body from self.body if set, see fanout().
+        """
+        self.normalize()
+        if self.body is None:
+            mixed = _mime_boundary()
+            content_type = 'multipart/mixed; boundary="%s"' % mixed
+            chunks = self.iter_body(mixed, chunk_size)
+        else:
+            content_type = self.body.content_type
+            chunks = self.body.iter_chunks(chunk_size)
+        yield self.make_headers(content_type)
+        yield from chunks
+    
+    def make_headers(self, content_type):
+        """return the top level headers of the message, with a new Date and Message-ID"""
+        def fmt_addr(addr):
+            return email.utils.formataddr(addr) if isinstance(addr, tuple) else addr
+        
+        return _mime_headers(
+            ('From', fmt_addr(self.from_)),
+            ('To', ', '.join(map(fmt_addr, self.to))),
+            ('Cc', ', '.join(map(fmt_addr, self.cc))),
+            ('Subject', self.subject),
+            ('Date', email.utils.formatdate(localtime=True)),
+            ('Message-ID', email.utils.make_msgid()),
+            ('MIME-Version', '1.0'),
+            ('Content-Type', content_type),
+        )
+    
+    def iter_body(self, mixed, chunk_size=STREAM_CHUNK_SIZE):
+        """generate the multipart/mixed body of the message, mixed is its boundary"""
+        self.normalize()
+        chunk_size = _b64_chunk_size(chunk_size)
+        bodies = [ (x, subtype) for x, subtype in ((self.text, 'plain'), (self.html, 'html'))
+                   if x is not None ]
+        if self.embeddeds:
+            # the html and its inline parts
+            related = _mime_boundary()
+            yield b'--%s\r\n' % mixed.encode()
+            yield _mime_headers(('Content-Type', 'multipart/related; boundary="%s"' % related))
+            outer = related
+        else:
+            outer = mixed
+        if bodies:
+            alternative = _mime_boundary()
+            yield b'--%s\r\n' % outer.encode()
+            yield _mime_headers(('Content-Type', 'multipart/alternative; boundary="%s"' % alternative))
+            for (content, charset), subtype in bodies:
+                yield b'--%s\r\n' % alternative.encode()
+                yield _mime_headers(('Content-Type', 'text/%s; charset="%s"' % (subtype, charset)),
+                                    ('Content-Transfer-Encoding', 'base64'))
+                yield _encode_b64(content.encode(charset))
+            yield b'--%s--\r\n' % alternative.encode()
+        if self.embeddeds:
+            for data, mime_type, cid in self.embeddeds:
+                yield b'--%s\r\n' % related.encode()
+                yield _mime_headers(('Content-Type', mime_type),
+                                    ('Content-Transfer-Encoding', 'base64'),
+                                    ('Content-ID', '<%s>' % cid),
+                                    ('Content-Disposition', 'inline'))
+                yield _encode_b64(data)
+            yield b'--%s--\r\n' % related.encode()
+        
+        for at in self.attachments:
+            mime_type = Email.attachment_mime_type(at)
+            file_name = Email.attachment_range(at)[3]
+            if file_name.isascii():
+                disposition = 'attachment; filename="%s"' % file_name
+            else:
+                disposition = 'attachment; filename*=%s' % email.utils.encode_rfc2231(file_name, 'utf-8')
+            yield b'--%s\r\n' % mixed.encode()
+            yield _mime_headers(('Content-Type', mime_type),
+                                ('Content-Transfer-Encoding', 'base64'),
+                                ('Content-Disposition', disposition))
+            if self.block_cache is not None:
+                yield from self.block_cache.iter_encoded(at, chunk_size)
+            else:
+                for data in Email.read_attachment(at, chunk_size):
+                    yield _encode_b64(data)
+        yield b'--%s--\r\n' % mixed.encode()
+    
+    def build_body(self, chunk_size=STREAM_CHUNK_SIZE, max_memory=STREAM_CHUNK_SIZE*16, metrics=None):
+        """return a MessageBody of the message, generated once on its first use"""
+        self.normalize()
+        mixed = _mime_boundary()
+        return MessageBody('multipart/mixed; boundary="%s"' % mixed, self.iter_body(mixed, chunk_size),
+                           max_memory, metrics)
+    
+    def fanout(self, recipients=None, batch_size=1, chunk_size=STREAM_CHUNK_SIZE, metrics=None):
+        """return copies of the email to recipients in batches of batch_size, sharing one body
+        
+        the body is built once, by build_body() when a copy is first sent, the copies only differ by their
+        To, Date and Message-ID headers and their smtp envelope, so the attachments
+        are read and encoded once for all recipients.
+        recipients: addresses put in To, to and cc by default. the bcc recipients
+                    are sent copies of their own, in batches with no To.
+        metrics: Metrics, a 'body' event is emitted with the size and build time.
+        
+        eg:
+        emls = eml.fanout(['mom@abc.com', 'dad@abc.com', 'sis@abc.com'])
+        results = send_emails(emls, streaming=True)
+        """
+        self.normalize()
+        bcc = []
+        if recipients is None:
+            recipients = self.to + self.cc
+            bcc = self.bcc
+        if self.body is None:
+            self.body = self.build_body(chunk_size, metrics=metrics)
+        ret = []
+        for addrs, hidden in ((recipients, False), (bcc, True)):
+            for i in range(0, len(addrs), batch_size):
+                eml = copy.copy(self)
+                eml.to = [] if hidden else list(addrs[i:i+batch_size])
+                eml.cc = []
+                # only in the envelope
+                eml.bcc = list(addrs[i:i+batch_size]) if hidden else []
+                ret.append(eml)
+        return ret
+    
+    def write_payload(self, out, chunk_size=STREAM_CHUNK_SIZE):
+        """write the message to a binary file object, eg: a spool file, return the size"""
+        size = 0
+        for chunk in self.iter_payload(chunk_size):
+            out.write(chunk)
+            size += len(chunk)
+        return size
+    
+    def send(self, to=None, smtp_pool=None, streaming=False):
+        """send the email, return a dict of refused recipients or an error string
+        
+        the connection is taken from smtp_pool or self.smtp_pool if set.
+        if streaming, the message is written to the connection by iter_payload(),
+        instead of being generated in memory.
+        """
         if to is not None:
             orig_to = self.to
             self.to = to
-            
-        payload = self.generate()   # normalize()'ed
-        ret = pyzmail.send_mail(
-            payload, self.from_addr(), self.to_addr(),
-            self.smtp[0], self.smtp[1], self.mode, self.user_name, self.password
-        )
+        if smtp_pool is None:
+            smtp_pool = self.smtp_pool
+        
+        if streaming:
+            ret = self.send_stream(smtp_pool)
+        else:
+            payload = self.generate()   # normalize()'ed
+            ret = self.send_payload(payload, smtp_pool)
         
         if to is not None:
             self.to = orig_to
         return ret
+    
+    def send_stream(self, smtp_pool=None, chunk_size=STREAM_CHUNK_SIZE):
+        """send the message generated by iter_payload(), see send()"""
+        self.normalize()
+        if smtp_pool is None:
+            smtp_pool = SMTPPool()
+            own_pool = True
+        else:
+            own_pool = False
+        try:
+            return self.deliver(smtp_pool, None, chunk_size)
+        except (smtplib.SMTPException, OSError) as e:
+            return smtp_error_message(e, self.smtp[0], self.smtp[1])
+        finally:
+            if own_pool:
+                smtp_pool.close()
+    
+    def send_payload(self, payload, smtp_pool=None):
+        """send a payload returned by generate(), see send()"""
+        if smtp_pool is None:
+            ret = pyzmail.send_mail(
+                payload, self.from_addr(), self.to_addr(),
+                self.smtp[0], self.smtp[1], self.mode, self.user_name, self.password
+            )
+        else:
+            try:
+                ret = self.deliver(smtp_pool, payload)
+            except (smtplib.SMTPException, OSError) as e:
+                ret = smtp_error_message(e, self.smtp[0], self.smtp[1])
+        return ret
+    
+    def deliver(self, smtp_pool, payload=None, chunk_size=STREAM_CHUNK_SIZE):
+        """send the email on smtp_pool, return a dict of refused recipients
+        
+        payload is returned by generate(), the message is streamed by
+        iter_payload() if None. unlike send(), smtp errors are raised.
+        """
+        self.normalize()
+        args = (self.from_addr(), self.to_addr(),
+                self.smtp[0], self.smtp[1], self.mode, self.user_name, self.password)
+        if payload is None:
+            return smtp_pool.sendmail_chunks(lambda: self.iter_payload(chunk_size), *args)
+        else:
+            return smtp_pool.sendmail(payload, *args)
+
+
+def is_transient_smtp_error(e):
+    """whether sending again later may succeed after the exception e"""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    elif isinstance(e, smtplib.SMTPAuthenticationError):
+        return False
+    elif isinstance(e, smtplib.SMTPSenderRefused):
+        return 400 <= e.smtp_code < 500
+    elif isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    else:
+        # a lost connection, not a local error, eg: an attachment that can not be read
+        return isinstance(e, (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError))
+
+
+class RateLimiter:
+    """limit the rate of messages sent to a smtp server
+    
+    messages_per_sec, bytes_per_sec: None for unlimited.
+    concurrency: max number of messages in flight, None for unlimited.
+    
+    a message of n bytes occupies the server for max(1/messages_per_sec, n/bytes_per_sec)
+    seconds, the following message waits until then.
+    """
+    def __init__(self, messages_per_sec=None, bytes_per_sec=None, concurrency=None):
+        self.messages_per_sec = messages_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.concurrency = concurrency
+        
+        self._lock = threading.Lock()
+        self._next = 0
+        self._slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+    
+    def wait(self, nbytes):
+        """block until a message of nbytes may be sent"""
+        cost = 0
+        if self.messages_per_sec:
+            cost = 1 / self.messages_per_sec
+        if self.bytes_per_sec:
+            cost = max(cost, nbytes / self.bytes_per_sec)
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + cost
+        if start > now:
+            time.sleep(start - now)
+    
+    def __enter__(self):
+        if self._slots is not None:
+            self._slots.acquire()
+        return self
+    
+    def __exit__(self, *args):
+        if self._slots is not None:
+            self._slots.release()
+
+
+# enhanced status codes of a sender over its quota or rate limit, eg:
+# 550 5.4.5 Daily user sending quota exceeded, 421 4.7.0 Try again later, rate limited
+_QUOTA_RE = re.compile(rb'\b[45]\.4\.5\b|\b[45]\.7\.\d{1,3}\b.*(quota|rate|limit|too many)'
+                       rb'|submissionquotaexceeded|\bsending (quota|limit)', re.IGNORECASE | re.DOTALL)
+# refusals of a recipient (eg: 5.2.2 mailbox full) or of the message content or size
+_MESSAGE_ERROR_RE = re.compile(rb'\b[45]\.(1\.\d{1,3}|2\.[234]|3\.4|6\.\d{1,3})\b')
+
+def is_quota_smtp_error(e):
+    """whether the exception e means the account went over a sending quota of the server
+    
+    the replies to the connection, to MAIL FROM and at the end of DATA, eg:
+    554 5.2.0 ...SubmissionQuotaExceededException, can be about the sender,
+    the refusals of a recipient (eg: a full mailbox) or of the message (eg: its
+    size) are not.
+    """
+    if not isinstance(e, smtplib.SMTPResponseException):
+        return False
+    resp = e.smtp_error if isinstance(e.smtp_error, bytes) else str(e.smtp_error).encode()
+    if isinstance(e, smtplib.SMTPDataError) and _MESSAGE_ERROR_RE.search(resp) is not None:
+        return False
+    return _QUOTA_RE.search(resp) is not None
+
+
+class SMTPAccount:
+    """a smtp account or relay and its sending quota, see AccountScheduler
+    
+    smtp, user_name, password, mode: as in Email.
+    from_: sender of the messages sent by this account, the sender of each email if None.
+    max_messages, max_bytes: quota per period seconds, None for unlimited.
+    concurrency: max number of messages in flight.
+    weight: share of the bytes relative to the other accounts.
+    name: name in AccountScheduler.report(), user_name@host:port if None.
+    """
+    def __init__(self, smtp, user_name=None, password=None, mode='tls', from_=None,
+                 max_messages=None, max_bytes=None, period=24*3600, concurrency=2, weight=1, name=None):
+        self.smtp = smtp if isinstance(smtp, tuple) else (smtp, 25)
+        self.user_name = user_name
+        self.password = password
+        self.mode = mode
+        self.from_ = from_
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.period = period
+        self.concurrency = concurrency
+        self.weight = weight
+        self.name = name or '%s@%s:%d' % ((user_name or '-',) + self.smtp)
+        
+        # (time, bytes) of the messages sent in the last period
+        self.sent = collections.deque()
+        self.sent_bytes = 0
+        self.inflight = 0
+        self.inflight_bytes = 0
+        # the error that took the account out
+        self.disabled = None
+    
+    def usage(self, now=None):
+        """return the (messages, bytes) sent in the last period"""
+        if now is None:
+            now = time.monotonic()
+        while self.sent and self.sent[0][0] <= now - self.period:
+            self.sent.popleft()
+        return len(self.sent), sum(x for _, x in self.sent)
+    
+    def has_quota(self, nbytes, now=None):
+        messages, used = self.usage(now)
+        if self.max_messages is not None and messages + self.inflight >= self.max_messages:
+            return False
+        if self.max_bytes is not None and used + self.inflight_bytes + nbytes > self.max_bytes:
+            return False
+        return True
+    
+    def apply(self, eml):
+        """return a copy of the Email sent by this account"""
+        eml = copy.copy(eml)
+        eml.smtp = self.smtp
+        eml.user_name = self.user_name
+        eml.password = self.password
+        eml.mode = self.mode
+        if self.from_ is not None:
+            eml.from_ = self.from_
+        return eml
+
+
+class AccountScheduler:
+    """share the messages among smtp accounts, balancing the bytes, see send_emails()
+    
+    a message goes to the account with a free slot and quota left that has sent
+    the fewest bytes for its weight, it waits while all such accounts are busy.
+    an account is taken out after an authentication error, or after a quota
+    error if another account then takes the message. when two accounts refuse
+    the same message for their quota, the message is at fault and no account
+    is taken out.
+    
+    accounts: SMTPAccount or dicts of SMTPAccount arguments.
+    
+    eg:
+    accounts = AccountScheduler([
+        {'smtp': ('smtp.abc.com', 587), 'user_name': 'xxx@abc.com', 'password': passwd1,
+         'from_': 'xxx@abc.com', 'max_messages': 500, 'max_bytes': 2*1024**3},
+        {'smtp': ('smtp.example.com', 587), 'user_name': 'xxx', 'password': passwd2, 'concurrency': 4},
+    ])
+    results = send_emails(emls, workers=6, accounts=accounts)
+    print(accounts.report())
+    """
+    def __init__(self, accounts):
+        self.accounts = [ x if isinstance(x, SMTPAccount) else SMTPAccount(**x) for x in accounts ]
+        # the names key report(), eg: a second 'xxx@smtp.abc.com:587' is 'xxx@smtp.abc.com:587#2'
+        names = collections.Counter()
+        for x in self.accounts:
+            names[x.name] += 1
+            if names[x.name] > 1:
+                x.name = '%s#%d' % (x.name, names[x.name])
+        self._cond = threading.Condition()
+    
+    def acquire(self, nbytes, exclude=()):
+        """take a slot for a message of nbytes, return the SMTPAccount or None if none has quota left
+        
+        exclude: accounts not to use, eg: those that refused the message.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                able = [ x for x in self.accounts
+                         if x.disabled is None and x not in exclude and x.has_quota(nbytes, now) ]
+                if not able:
+                    return None
+                free = [ x for x in able if x.inflight < x.concurrency ]
+                if free:
+                    account = min(free, key=lambda x: (x.sent_bytes + x.inflight_bytes) / x.weight)
+                    account.inflight += 1
+                    account.inflight_bytes += nbytes
+                    return account
+                self._cond.wait()
+    
+    def release(self, account, nbytes, error=None):
+        """release the slot taken by acquire(), return True if the message is to be sent by another account
+        
+        error: the exception of the sending, None if the message was accepted.
+        an authentication error takes the account out, see disable() for a quota error.
+        """
+        with self._cond:
+            account.inflight -= 1
+            account.inflight_bytes -= nbytes
+            if error is None:
+                account.sent.append((time.monotonic(), nbytes))
+                account.sent_bytes += nbytes
+            elif isinstance(error, smtplib.SMTPAuthenticationError):
+                account.disabled = error
+            self._cond.notify_all()
+            return error is not None and (isinstance(error, smtplib.SMTPAuthenticationError)
+                                          or is_quota_smtp_error(error))
+    
+    def disable(self, account, error):
+        """take the account out, error is the reason"""
+        with self._cond:
+            account.disabled = error
+            self._cond.notify_all()
+    
+    def report(self):
+        """return {account name: {'messages', 'bytes', 'disabled'}} of the last period"""
+        with self._cond:
+            ret = {}
+            for x in self.accounts:
+                messages, nbytes = x.usage()
+                ret[x.name] = {'messages': messages, 'bytes': nbytes,
+                               'disabled': None if x.disabled is None else repr(x.disabled)}
+            return ret
+
+
+def send_emails(emails, workers=4, rate_limits={}, default_rate_limit=None, smtp_pool=None, on_result=None,
+                streaming=False, retries=0, backoff=1.0, max_backoff=300, metrics=None, accounts=None):
+    """send a list of Email concurrently, return a list of results in input order
+    
+    emails can be a generator, it is consumed as the workers get free, so
+    sending starts before the later emails are made.
+    
+    workers: max number of messages in flight.
+    rate_limits: dict of smtp host -> RateLimiter or dict of RateLimiter arguments.
+    default_rate_limit: RateLimiter or dict for the hosts not in rate_limits.
+    smtp_pool: SMTPPool for the emails without one, a private one is used if None.
+    on_result: called with each result as soon as the message is done.
+    streaming: stream each message to the server by Email.send_stream(),
+               'bytes' is then estimated from the attachment sizes.
+    retries: times to retry a message after a transient smtp error, waiting
+             backoff, 2*backoff, 4*backoff ... seconds, at most max_backoff.
+    metrics: Metrics, a 'message' event is emitted for each result, it is
+             also given to the private SMTPPool for the smtp events.
+    accounts: AccountScheduler, or a list for one, each message is sent by one of
+              its accounts instead of the smtp server and account of the Email.
+              workers should be at least the sum of the accounts' concurrency.
+    
+    each result is a dict:
+    {
+        'index'     : position in emails,
+        'email'     : the Email,
+        'ok'        : True if all recipients are accepted,
+        'result'    : return value of Email.send(), None if generate() failed,
+        'error'     : exception raised by generate() or by the last try of sending, or None,
+        'attempts'  : number of times the message was sent,
+        'bytes'     : size of the payload,
+        'account'   : name of the SMTPAccount that sent the message last, None without accounts,
+        'generate_time', 'wait_time', 'send_time': seconds,
+    }
+    
+    eg:
+    results = send_emails(groups2Emails(grps, ...), workers=8,
+                          rate_limits={'smtp.example.com': {'messages_per_sec': 2, 'bytes_per_sec': 5*1024*1024}})
+    failed = [ x for x in results if not x['ok'] ]
+    """
+    def make_limiter(arg):
+        if arg is None or isinstance(arg, RateLimiter):
+            return arg
+        return RateLimiter(**arg)
+    limiters = { host: make_limiter(x) for host, x in rate_limits.items() }
+    default_limiter = make_limiter(default_rate_limit)
+    limiters_lock = threading.Lock()
+    
+    def get_limiter(host):
+        with limiters_lock:
+            if host not in limiters:
+                # each host gets its own copy of the default limit
+                limiters[host] = (None if default_limiter is None else
+                                  RateLimiter(default_limiter.messages_per_sec, default_limiter.bytes_per_sec,
+                                              default_limiter.concurrency))
+            return limiters[host]
+    
+    own_pool = smtp_pool is None
+    if own_pool:
+        smtp_pool = SMTPPool(metrics=metrics)
+    if accounts is not None and not isinstance(accounts, AccountScheduler):
+        accounts = AccountScheduler(accounts)
+    
+    def send_one(i, eml):
+        result = {
+            'index': i, 'email': eml, 'ok': False, 'result': None, 'error': None, 'attempts': 0,
+            'bytes': 0, 'account': None, 'generate_time': 0, 'wait_time': 0, 'send_time': 0,
+        }
+        
+        def try_send(eml, payload):
+            limiter = get_limiter(eml.smtp[0])
+            if limiter is None:
+                limiter = RateLimiter()
+            with limiter:
+                t1 = time.monotonic()
+                limiter.wait(result['bytes'])
+                t2 = time.monotonic()
+                result['wait_time'] += t2 - t1
+                result['attempts'] += 1
+                try:
+                    result['result'] = eml.deliver(eml.smtp_pool or smtp_pool, payload)
+                    result['error'] = None
+                except (smtplib.SMTPException, OSError) as e:
+                    result['result'] = smtp_error_message(e, eml.smtp[0], eml.smtp[1])
+                    result['error'] = e
+                result['send_time'] += time.monotonic() - t2
+        
+        def try_accounts(eml, payload):
+            # fail over to the next account until one takes the message
+            refused = {}   # account -> its quota error
+            while True:
+                account = accounts.acquire(result['bytes'], refused)
+                if account is None:
+                    if not refused:
+                        result['result'] = 'no smtp account has quota left for %s' % sizeof_fmt(result['bytes'])
+                        result['error'] = Exception(result['result'])
+                    return
+                result['account'] = account.name
+                sent = account.apply(eml)
+                try:
+                    data = payload
+                    if payload is not None and sent.from_ != eml.from_:
+                        t0 = time.monotonic()
+                        data = sent.generate()
+                        result['generate_time'] += time.monotonic() - t0
+                    try_send(sent, data)
+                except Exception as e:
+                    accounts.release(account, result['bytes'], e)
+                    raise
+                if not accounts.release(account, result['bytes'], result['error']):
+                    if result['error'] is None:
+                        # the message is fine, the accounts that refused it are over their quota
+                        for x, e in refused.items():
+                            accounts.disable(x, e)
+                    return
+                if not isinstance(result['error'], smtplib.SMTPAuthenticationError):
+                    if refused:
+                        # refused by two accounts, the message is at fault
+                        return
+                    refused[account] = result['error']
+        
+        try:
+            t0 = time.monotonic()
+            payload = None
+            if streaming:
+                eml.normalize()
+                if eml.body is not None:
+                    result['bytes'] = eml.body.size
+                else:
+                    result['bytes'] = sum(base64_size(Email.attachment_size(x)) for x in eml.attachments)
+            else:
+                payload = eml.generate()   # normalize()'ed
+                result['bytes'] = len(payload)
+            result['generate_time'] = time.monotonic() - t0
+            
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(min(backoff * 2 ** (attempt - 1), max_backoff))
+                if accounts is None:
+                    try_send(eml, payload)
+                else:
+                    try_accounts(eml, payload)
+                if result['error'] is None or not is_transient_smtp_error(result['error']):
+                    break
+            result['ok'] = result['result'] == {}
+        except Exception as e:
+            result['error'] = e
+        if metrics is not None:
+            metrics.emit('message', index=i, ok=result['ok'], account=result['account'],
+                         error=None if result['error'] is None else repr(result['error']),
+                         **{ k: result[k] for k in ('attempts', 'bytes', 'generate_time', 'wait_time', 'send_time') })
+        if on_result is not None:
+            on_result(result)
+        return result
+    
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+            # bound the messages queued ahead of the workers
+            slots = threading.BoundedSemaphore(2 * workers)
+            futures = []
+            for i, eml in enumerate(emails):
+                slots.acquire()
+                future = ex.submit(send_one, i, eml)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+            return [ x.result() for x in futures ]
+    finally:
+        if own_pool:
+            smtp_pool.close()
 
 
-def send_grouped_files(from_, to=None, files=[], ordered_by=None, max_size=50*1000*1000, **kwd):
+def send_grouped_files(from_, to=None, files=[], ordered_by=None, max_size=50*1000*1000,
+                       smtp_pool=None, estimator=None, packing='next_fit', window=8,
+                       split=False, part_size=None, on_result=None, metrics=None, **kwd):
+    """send files in groups, one connection is reused for all groups
+    
+    smtp_pool: a SMTPPool to share, a private one is used if None.
+    estimator: a WireSizeEstimator, max_size is then the size of the encoded email.
+    packing, window: the bin packing strategy, see pack_sizes().
+    split, part_size: send files exceeding max_size in parts, see split_meta_data().
+                      the text part has a JSON line of meta data per part, for join_parts().
+    on_result: called as on_result(index, result of Email.send()) for each group,
+               the result is printed if None.
+    metrics: Metrics for 'message' and smtp events.
+    """
     if to is None:
         to = [from_]
         
-    files = list(files)     # copy
+    # stat each file once
+    files = [ FileEntry(x, file_stat(x)) for x in files ]
     sort_func = {
         'file_name' : None,
-        'size'      : os.path.getsize,
-        'date'      : os.path.getmtime,
-        'time'      : os.path.getmtime,
-        'modified'  : os.path.getmtime,
-        'created'   : os.path.getctime,
-        'accessed'  : os.path.getatime,
+        'size'      : lambda x: x.stat_result.st_size,
+        'date'      : lambda x: x.stat_result.st_mtime,
+        'time'      : lambda x: x.stat_result.st_mtime,
+        'modified'  : lambda x: x.stat_result.st_mtime,
+        'created'   : lambda x: x.stat_result.st_ctime,
+        'accessed'  : lambda x: x.stat_result.st_atime,
     }
     if ordered_by is not None:
         files.sort(key=sort_func[ordered_by])
     
-    files_size = list(map(os.path.getsize, files))
-    groups = [[]]
-    total_size = 0
-    for i, x in enumerate(files_size):
-        if x > max_size:
-            raise Exception('file "%s", size %d, exceed max_size %d\n' % (files[i], x, max_size))
+    base_size = 0
+    if estimator is not None:
+        # the text part lists the attachments, there is no html part
+        base_size = estimator.header_size + estimator.margin + estimator.part_header_size
+    
+    def item_size(size, name, text):
+        if estimator is None:
+            return size
+        return estimator.attachment_size(size, name) + base64_size(len(text.encode('UTF-8')) + 1)
+    
+    # list of (attachment, line in the text part)
+    items = []
+    files_size = []
+    for x in files:
+        size = item_size(x.stat_result.st_size, os.path.basename(x), x)
+        if size + base_size < max_size or not split:
+            items.append((x, x))
+            files_size.append(size)
+            continue
+        
+        name = os.path.basename(x)
+        if estimator is None:
+            max_part = max_size - base_size - 1
         else:
-            if x + total_size < max_size:
-                groups[-1].append(files[i])
-                total_size += x
+            # reserve 1KiB for the JSON line
+            max_part = (max_size - base_size - item_size(0, name, ' ' * 1024)) * 3 * 76 // (4 * 78)
+        if part_size is not None:
+            max_part = min(max_part, part_size)
+        file_hash, parts = split_file(x, max_part)
+        for index, (offset, size, hashes) in enumerate(parts, 1):
+            part_name = PART_NAME_FMT.format(name=name, index=index, count=len(parts))
+            meta = {
+                'file': { 'name': part_name, 'path': os.path.normpath(x), 'size': size, 'hash': hashes },
+                'part': {
+                    'name': name, 'index': index, 'count': len(parts), 'offset': offset,
+                    'file_size': x.stat_result.st_size, 'file_hash': file_hash,
+                },
+            }
+            text = json_encode(meta)
+            items.append(({ 'path': x, 'offset': offset, 'size': size, 'name': part_name }, text))
+            files_size.append(item_size(size, part_name, text))
+    
+    for i, x in enumerate(files_size):
+        if x + base_size > max_size:
+            raise Exception('file "%s", size %d, exceed max_size %d\n' % (items[i][1], x, max_size))
+    groups = [ [ items[i] for i in x ]
+               for x in pack_sizes(files_size, max_size, base_size, packing, window) ]
+    
+    own_pool = smtp_pool is None
+    if own_pool:
+        smtp_pool = SMTPPool(metrics=metrics)
+    eml = Email(from_=from_, to=to, smtp_pool=smtp_pool, **kwd)
+    try:
+        for i, grp in enumerate(groups):
+            eml.subject = 'batch mailer task %d' % i
+            eml.text = '\n'.join(text for _, text in grp)
+            eml.attachments = [ at for at, _ in grp ]
+            t0 = time.perf_counter()
+            payload = eml.generate()
+            t1 = time.perf_counter()
+            ret = eml.send_payload(payload, smtp_pool)
+            if metrics is not None:
+                metrics.emit('message', index=i, ok=ret == {}, error=None if isinstance(ret, dict) else ret,
+                             attempts=1, bytes=len(payload), generate_time=t1 - t0, wait_time=0,
+                             send_time=time.perf_counter() - t1)
+            if on_result is not None:
+                on_result(i, ret)
             else:
-                groups.append([files[i]])
-                total_size = x
-    
-    eml = Email(from_=from_, to=to, **kwd)
-    for i, attachments in enumerate(groups):
-        eml.subject = 'batch mailer task %d' % i
-        eml.text = '\n'.join(attachments)
-        eml.attachments = attachments
-        ret = eml.send()
-        print('task: %d\n%s\n' % (i, ret))
-
-def get_meta_data(file_name, thumbnail_size=50):
-    """return a dict of a file's meta data"""
+                print('task: %d\n%s\n' % (i, ret))
+    finally:
+        if own_pool:
+            smtp_pool.close()
+
+# digests computed by get_meta_data() by default
+DEFAULT_HASH_METHODS = ('md5', 'sha256')
+# read size of the streaming hasher
+HASH_CHUNK_SIZE = 1024*1024
+
+def hash_file(file, methods=DEFAULT_HASH_METHODS, chunk_size=HASH_CHUNK_SIZE, head=b'', size=None,
+              timings=None):
+    """hash a file in a single pass, return a dict of {method: hexdigest}
+    
+    file is a file name or a binary file object. every digest is fed from
+    the same chunk, so the data is read once and memory usage stays at
+    chunk_size no matter how large the file is.
+    head is the data already read from the file object, it is hashed first.
+    size limits the bytes read after head, None to read to the end.
+    timings: a dict, the seconds of reading and hashing are added to
+             its 'read_time' and 'hash_time'.
+    
+    eg:
+    hash_file('a.mp4', methods=('blake2b',))
+    """
+    hashers = [ hashlib.new(method) for method in methods ]
+    if not hashers:
+        return {}
+    
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with open(file, 'rb') as f:
+            return hash_file(f, methods, chunk_size, head, size, timings)
+    
+    read_time = hash_time = 0
+    clock = time.perf_counter
+    t0 = clock()
+    for h in hashers:
+        h.update(head)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while size is None or size > 0:
+        t1 = clock()
+        hash_time += t1 - t0
+        n = file.readinto(buf if size is None or size >= chunk_size else view[:size])
+        t0 = clock()
+        read_time += t0 - t1
+        if not n:
+            break
+        if size is not None:
+            size -= n
+        for h in hashers:
+            h.update(view[:n])
+    if timings is not None:
+        timings['read_time'] = timings.get('read_time', 0) + read_time
+        timings['hash_time'] = timings.get('hash_time', 0) + hash_time
+    return { method: h.hexdigest() for method, h in zip(methods, hashers) }
+
+def probe_image(file_name, thumbnail_size=50):
+    """return a dict of image info of a file, or None if it's not an image or PIL is missing
+    
+    only the header is read for the format, size and exif.
+    the image is decoded only for the thumbnail, JPEG is decoded in draft
+    mode (DCT scaling) at the smallest scale not smaller than the thumbnail.
+    """
+    try:
+        import PIL, PIL.Image, PIL.ExifTags
+    except ImportError:
+        return
+    
+    image = None
+    try:
+        # open() reads the header only
+        with PIL.Image.open(file_name) as im:
+            # basic image info
+            image = {
+                'format': im.format,
+                'size'  : im.size,
+                'mode'  : im.mode,
+            }
+            
+            # image exif
+            exif = im._getexif() if 'exif' in im.info and hasattr(im, '_getexif') else None
+            if exif:
+                exif = {
+                    PIL.ExifTags.TAGS[k]: v
+                    for k, v in exif.items()
+                    if k in PIL.ExifTags.TAGS
+                }
+                if 'DateTimeOriginal' in exif:
+                    image['date'] = exif['DateTimeOriginal']
+                if 'Model' in exif:
+                    image['device'] = exif['Model']
+            
+            # image thumbnail, must be last
+            if thumbnail_size is not None and thumbnail_size > 0:
+                max_w_h = max(image['size'])
+                if max_w_h <= thumbnail_size:
+                    resize_size = image['size']
+                else:
+                    ratio = thumbnail_size / max_w_h
+                    resize_size = (max(1, round(image['size'][0] * ratio)),
+                                   max(1, round(image['size'][1] * ratio)))
+                # reduced decoding, no-op for formats other than JPEG
+                im.draft('RGB', resize_size)
+                im.thumbnail(resize_size)
+                if im.mode not in ('RGB', 'L'):
+                    im = im.convert('RGB')
+                buf = io.BytesIO()
+                im.save(buf, format='JPEG', optimize=True)
+                image['thumbnail'] = buf.getvalue()
+    except IOError:
+        pass
+    return image
+
+def get_meta_data(file_name, thumbnail_size=50, hash_methods=DEFAULT_HASH_METHODS,
+                  chunk_size=HASH_CHUNK_SIZE, cache=None, timings=None, **kwd):
+    """return a dict of a file's meta data
+    
+    hash_methods is a sequence of hashlib algorithm names, eg: ('blake2b',),
+    an empty sequence skips hashing.
+    cache is a MetaDataCache, checked before the file is read.
+    timings is a dict, the seconds of each step are added to its 'read_time',
+    'hash_time', 'magic_time' and 'image_time'.
+    """
+    st = file_stat(file_name)
+    if cache is not None:
+        meta = cache.get(file_name, thumbnail_size, hash_methods, st)
+        if meta is None:
+            meta = get_meta_data(FileEntry(file_name, st), thumbnail_size, hash_methods, chunk_size,
+                                 timings=timings, **kwd)
+            cache.put(file_name, meta, thumbnail_size, st)
+        return meta
+    
     meta = {
         'file': {
             'name': os.path.normpath(file_name).rsplit(os.sep, 1)[-1],
             'path': os.path.normpath(file_name),
-            'size': os.path.getsize(file_name),
+            'size': st.st_size,
             'date': {
-                'modified': os.path.getmtime(file_name),
-                'created' : os.path.getctime(file_name),
-#                     'accessed': os.path.getatime(file_name),
+                'modified': st.st_mtime,
+                'created' : st.st_ctime,
+#                     'accessed': st.st_atime,
             },
         },
     }
+    
+    if timings is None:
+        timings = {}
+    clock = time.perf_counter
+    t0 = clock()
     with open(file_name, 'rb') as file:
-        # temporary var
-        meta['file']['data'] = file.read()
+        head = file.read(chunk_size)
+        t1 = clock()
+        # libmagic only needs the head of the file
+        mime_type, meta['type_description'] = type_detector().detect(file_name, head, st)
+        meta['mime_type'] = mime_type
+        t2 = clock()
+        # hash, single pass over the rest of the file
+        meta['file']['hash'] = hash_file(file, hash_methods, chunk_size, head, timings=timings)
+    del head
+    t3 = clock()
+    
+    image = probe_image(file_name, thumbnail_size)
+    if image is not None:
+        meta['image'] = image
+    
+    timings['read_time'] = timings.get('read_time', 0) + t1 - t0
+    timings['magic_time'] = timings.get('magic_time', 0) + t2 - t1
+    timings['image_time'] = timings.get('image_time', 0) + clock() - t3
+    return meta
+
+class MetaDataCache:
+    """on-disk cache of get_meta_data() results, backed by sqlite
+    
+    an entry is keyed by (path, size, mtime_ns, inode), so a hit costs a
+    stat of the file. thumbnails are stored per thumbnail_size.
+    when max_size (bytes) is set, least recently used entries are evicted
+    on flush().
+    
+    usage:
+    with MetaDataCache(os.path.expanduser('~/.batchmail.sqlite'), max_size=256*1024*1024) as cache:
+        grps = files2groups(glob('*.JPG'), cache=cache)
+        print(cache.report())
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (
+                path        TEXT PRIMARY KEY,
+                size        INTEGER,
+                mtime_ns    INTEGER,
+                inode       INTEGER,
+                meta        TEXT,
+                bytes       INTEGER,
+                used        REAL
+            );
+            CREATE TABLE IF NOT EXISTS thumbnail (
+                path            TEXT,
+                thumbnail_size  INTEGER,
+                data            BLOB,
+                bytes           INTEGER,
+                PRIMARY KEY (path, thumbnail_size)
+            );
+        ''')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    @staticmethod
+    def _identity(st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+    
+    def get(self, file_name, thumbnail_size=None, hash_methods=DEFAULT_HASH_METHODS, st=None):
+        """return the cached meta data of file_name, or None on a miss"""
+        if st is None:
+            st = file_stat(file_name)
+        path = os.path.abspath(file_name)
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, inode, meta FROM meta WHERE path=?',
+                                   (path,)).fetchone()
+            meta = None
+            if row is not None and tuple(row[:3]) == MetaDataCache._identity(st):
+                meta = json.loads(row[3])
+                if not set(hash_methods) <= set(meta['file']['hash']):
+                    meta = None
+                elif 'image' in meta and thumbnail_size:
+                    thumb = self._db.execute(
+                        'SELECT data FROM thumbnail WHERE path=? AND thumbnail_size=?',
+                        (path, thumbnail_size)).fetchone()
+                    if thumb is None:
+                        meta = None
+                    elif thumb[0] is not None:
+                        meta['image']['thumbnail'] = thumb[0]
+            if meta is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE meta SET used=? WHERE path=?', (time.time(), path))
         
-    def file_magic_from_buffer(data):
-        try:
-            import magic
-            return magic.from_buffer(data, mime=False).decode('UTF-8')
-        except ImportError:
+        # the file may be reached by another relative path
+        meta['file']['name'] = os.path.normpath(file_name).rsplit(os.sep, 1)[-1]
+        meta['file']['path'] = os.path.normpath(file_name)
+        meta['file']['date']['created'] = st.st_ctime
+        meta['file']['hash'] = { x: meta['file']['hash'][x] for x in hash_methods }
+        if 'image' in meta:
+            meta['image']['size'] = tuple(meta['image']['size'])
+        return meta
+    
+    def put(self, file_name, meta, thumbnail_size=None, st=None):
+        """store the meta data of file_name"""
+        if st is None:
+            st = file_stat(file_name)
+        path = os.path.abspath(file_name)
+        record = dict(meta)
+        thumb = None
+        if 'image' in record:
+            record['image'] = dict(record['image'])
+            thumb = record['image'].pop('thumbnail', None)
+        js = json_encode(record)
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, inode FROM meta WHERE path=?',
+                                   (path,)).fetchone()
+            if row is not None and tuple(row) != MetaDataCache._identity(st):
+                # file changed, thumbnails of other sizes are stale
+                self._db.execute('DELETE FROM thumbnail WHERE path=?', (path,))
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (path,) + MetaDataCache._identity(st) + (js, len(js), time.time()))
+            if 'image' in record and thumbnail_size:
+                self._db.execute('INSERT OR REPLACE INTO thumbnail VALUES (?, ?, ?, ?)',
+                                 (path, thumbnail_size, thumb, len(thumb) if thumb else 0))
+    
+    def total_bytes(self):
+        """return the size of cached data in bytes"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT (SELECT IFNULL(SUM(bytes), 0) FROM meta) + (SELECT IFNULL(SUM(bytes), 0) FROM thumbnail)'
+            ).fetchone()[0]
+    
+    def evict(self, max_size=None):
+        """evict least recently used entries until the cache is smaller than max_size"""
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return
+        excess = self.total_bytes() - max_size
+        if excess <= 0:
             return
+        with self._lock:
+            rows = self._db.execute('''
+                SELECT path, bytes + (SELECT IFNULL(SUM(bytes), 0) FROM thumbnail WHERE thumbnail.path = meta.path)
+                FROM meta ORDER BY used
+            ''')
+            victims = []
+            for path, size in rows:
+                if excess <= 0:
+                    break
+                victims.append((path,))
+                excess -= size
+            self._db.executemany('DELETE FROM meta WHERE path=?', victims)
+            self._db.executemany('DELETE FROM thumbnail WHERE path=?', victims)
+    
+    def flush(self):
+        """evict if needed and commit to disk"""
+        self.evict()
+        with self._lock:
+            self._db.commit()
+    
+    def close(self):
+        self.flush()
+        self._db.close()
+    
+    def report(self):
+        """return a dict of cache statistics"""
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM meta').fetchone()[0]
+            thumbnails = self._db.execute('SELECT COUNT(*) FROM thumbnail').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'hit_rate'  : self.hits / lookups if lookups else None,
+            'entries'   : entries,
+            'thumbnails': thumbnails,
+            'bytes'     : self.total_bytes(),
+        }
 
-    meta['type_description'] = file_magic_from_buffer(meta['file']['data'])
-        
-    def hash_data(data, method):
-        return hashlib.new(method, data).hexdigest()
+class MetaDataError(Exception):
+    """raised by files2meta_data_list() when some files failed
     
-    # hash
-    meta['file']['hash'] = {
-        method: hash_data(meta['file']['data'], method)
-        for method in ('md5', 'sha256')
-    }
+    failures is a list of (file_name, exception), in input order.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__('%d file(s) failed: %s' % (
+            len(failures), ', '.join('"%s" (%r)' % x for x in failures[:5])
+            + (' ...' if len(failures) > 5 else '')))
+
+def _try_get_meta_data(file_name, **kwd):
+    """run get_meta_data() in a worker, return (meta, None, timings) or (None, exception, timings)"""
+    timings = {}
+    t0 = time.perf_counter()
+    try:
+        meta, exc = get_meta_data(file_name, timings=timings, **kwd), None
+    except Exception as e:
+        meta, exc = None, e
+    timings['seconds'] = time.perf_counter() - t0
+    return meta, exc, timings
+
+def _try_get_meta_data_list(file_names, **kwd):
+    """_try_get_meta_data() for a chunk of files, one task of a worker"""
+    return [ _try_get_meta_data(x, **kwd) for x in file_names ]
+
+def files2meta_data_list(files, thumbnail_size=80, workers=None, pool='process', pool_chunksize=8,
+                         errors='raise', on_error=None, cache=None, metrics=None, **kwd):
+    """return a list of meta data of files, in input order
+    
+    workers: number of workers, None or 1 runs in the calling thread.
+    pool: 'process' or 'thread'.
+    pool_chunksize: number of files sent to a process worker at a time.
+    errors: 'raise' raises MetaDataError after all files are processed,
+            'skip' leaves failed files out of the result.
+    on_error: called as on_error(file_name, exception) for each failed file.
+    cache: a MetaDataCache, only missed files are sent to the workers.
+    metrics: Metrics, a 'file' event is emitted for each file, with the
+             seconds spent in the worker.
+    compact: return MetaRecord instead of dicts, see iter_meta_data().
+    
+    eg:
+    metas = files2meta_data_list(glob('*.JPG'), workers=os.cpu_count())
+    # 200k files, the thumbnails in a temporary file
+    metas = files2meta_data_list(find_files('photos'), workers=8, compact=ThumbnailSpool())
+    """
+    return list(iter_meta_data(files, thumbnail_size, workers, pool, pool_chunksize, errors, on_error,
+                               cache, metrics, **kwd))
+
+def iter_meta_data(files, thumbnail_size=80, workers=None, pool='process', pool_chunksize=8,
+                   errors='raise', on_error=None, cache=None, metrics=None, lookahead=4, compact=False, **kwd):
+    """yield the meta data of files in input order, see files2meta_data_list()
+    
+    files can be a generator, eg: iter_files(). at most lookahead chunks per
+    worker are in flight, so the meta data of the first files is yielded
+    while the later files are still found or hashed.
+    with errors='raise', MetaDataError is raised after the last meta data.
+    compact: yield MetaRecord instead of dicts, the thumbnails are made again
+             when rendered. or a ThumbnailSpool to keep them on disk.
+             see compact_meta_data().
+    """
+    if errors not in ('raise', 'skip'):
+        raise ValueError('errors must be "raise" or "skip", not %r' % errors)
+    func = functools.partial(_try_get_meta_data_list, thumbnail_size=thumbnail_size, **kwd)
+    failures = []
+    
+    def chunks():
+        """yield lists of (file_name, stat result, result or None if to compute)"""
+        chunk = []
+        for file_name in files:
+            st = result = None
+            # look up the cache in this process, the workers get the misses
+            if cache is not None:
+                try:
+                    st = file_stat(file_name)
+                except OSError as e:
+                    result = (None, e, None)
+                else:
+                    meta = cache.get(file_name, thumbnail_size, kwd.get('hash_methods', DEFAULT_HASH_METHODS), st)
+                    if meta is not None:
+                        result = (meta, None, None)
+            chunk.append((file_name, st, result))
+            if len(chunk) >= pool_chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    
+    def todo(chunk):
+        return [ file_name if st is None else FileEntry(file_name, st)
+                 for file_name, st, result in chunk if result is None ]
+    
+    def finish(chunk, computed):
+        computed = iter(computed)
+        for file_name, st, result in chunk:
+            if result is None:
+                result = next(computed)
+                if cache is not None and result[1] is None:
+                    cache.put(file_name, result[0], thumbnail_size, st)
+            meta, exc, timings = result
+            if metrics is not None:
+                metrics.emit('file', path=os.fspath(file_name), size=meta['file']['size'] if exc is None else 0,
+                             cached=timings is None and exc is None, error=None if exc is None else repr(exc),
+                             **(timings or {}))
+            if exc is None:
+                if compact is not False:
+                    meta = compact_meta_data(meta, None if compact is True else compact, thumbnail_size)
+                yield meta
+            else:
+                failures.append((file_name, exc))
+                if on_error is not None:
+                    on_error(file_name, exc)
+    
+    if workers is None or workers <= 1:
+        for chunk in chunks():
+            yield from finish(chunk, func(todo(chunk)))
+    else:
+        executor = {
+            'process'   : concurrent.futures.ProcessPoolExecutor,
+            'thread'    : concurrent.futures.ThreadPoolExecutor,
+        }[pool]
+        with executor(max_workers=workers) as ex:
+            inflight = collections.deque()
+            for chunk in chunks():
+                files_todo = todo(chunk)
+                inflight.append((chunk, ex.submit(func, files_todo) if files_todo else None))
+                if len(inflight) >= workers * lookahead:
+                    chunk, future = inflight.popleft()
+                    yield from finish(chunk, [] if future is None else future.result())
+            while inflight:
+                chunk, future = inflight.popleft()
+                yield from finish(chunk, [] if future is None else future.result())
+    if cache is not None:
+        cache.flush()
+    
+    if failures and errors == 'raise':
+        raise MetaDataError(failures)
+
+class _Missing:
+    """a missing value, of sort_value() and of the keys of a MetaRecord"""
+    def __reduce__(self):
+        # unpickled as the same object
+        return '_MISSING'
+    
+    def __repr__(self):
+        return '_MISSING'
+
+_MISSING = _Missing()
+
+class ThumbnailSpool:
+    """append-only temporary file keeping thumbnails out of memory, see compact_meta_data()"""
+    def __init__(self, dir=None):
+        self._file = tempfile.TemporaryFile(dir=dir)
+        self._lock = threading.Lock()
+        self._size = 0
+    
+    def put(self, data):
+        """store data, return (offset, length) to get() it"""
+        with self._lock:
+            offset = self._size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._size += len(data)
+        return offset, len(data)
+    
+    def get(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+    
+    def close(self):
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+_thumbnail_spool = None
+
+def thumbnail_spool():
+    """return the ThumbnailSpool of this process, keeping the thumbnails made again by ImageRecord"""
+    global _thumbnail_spool
+    if _thumbnail_spool is None:
+        _thumbnail_spool = ThumbnailSpool()
+    return _thumbnail_spool
+
+class _Record(collections.abc.Mapping):
+    """read-only mapping over a __slots__ record, used like the meta data dicts
+    
+    _keys lists the keys in the order of the dict, a key whose value is
+    _MISSING is left out.
+    """
+    __slots__ = ()
+    _keys = ()
+    
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+    
+    def _has(self, key):
+        return getattr(self, key) is not _MISSING
+    
+    def __contains__(self, key):
+        return key in self._keys and self._has(key)
+    
+    def __iter__(self):
+        return (k for k in self._keys if self._has(k))
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+    
+    def __json__(self):
+        return dict(self)
+    
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self))
+
+class FileRecord(_Record):
+    """the 'file' of a MetaRecord, digests are kept as bytes and the name is taken from the path"""
+    __slots__ = ('path', 'size', 'modified', 'created', '_hash')
+    _keys = ('name', 'path', 'size', 'date', 'hash')
+    
+    def __init__(self, path, size, modified, created, hash):
+        self.path = path
+        self.size = size
+        self.modified = modified
+        self.created = created
+        self._hash = tuple((sys.intern(method), bytes.fromhex(digest)) for method, digest in hash.items())
+    
+    @property
+    def name(self):
+        return self.path.rsplit(os.sep, 1)[-1]
+    
+    @property
+    def date(self):
+        return { 'modified': self.modified, 'created': self.created }
+    
+    @property
+    def hash(self):
+        return { method: digest.hex() for method, digest in self._hash }
+
+class ImageRecord(_Record):
+    """the 'image' of a MetaRecord, the thumbnail is read from a ThumbnailSpool or made again
+    
+    a thumbnail made again is kept in thumbnail_spool(), so the image is decoded
+    once. if it can't be made, eg: the file is gone, the record has no thumbnail.
+    """
+    __slots__ = ('format', 'width', 'height', 'mode', 'date', 'device', '_thumbnail', '_source')
+    _keys = ('format', 'size', 'mode', 'date', 'device', 'thumbnail')
+    
+    def __init__(self, image, source, spool=None, thumbnail_size=None):
+        self.format = sys.intern(image['format'])
+        self.width, self.height = image['size']
+        self.mode = sys.intern(image['mode'])
+        self.date = image.get('date', _MISSING)
+        self.device = sys.intern(image['device']) if isinstance(image.get('device'), str) else image.get('device', _MISSING)
+        self._source = source
+        # _MISSING, (spool, offset, length), or the size to make it again from the source file
+        self._thumbnail = _MISSING
+        if image.get('thumbnail') is not None:
+            if spool is not None:
+                self._thumbnail = (spool,) + spool.put(image['thumbnail'])
+            elif thumbnail_size:
+                self._thumbnail = thumbnail_size
+    
+    @property
+    def size(self):
+        return (self.width, self.height)
+    
+    def _has(self, key):
+        # don't read the thumbnail
+        return (self._thumbnail if key == 'thumbnail' else getattr(self, key)) is not _MISSING
     
+    @property
+    def thumbnail(self):
+        if self._thumbnail is not _MISSING and not isinstance(self._thumbnail, tuple):
+            # the thumbnail size, make it again
+            image = probe_image(self._source, self._thumbnail)
+            data = None if image is None else image.get('thumbnail')
+            if data is None:
+                self._thumbnail = _MISSING
+            else:
+                spool = thumbnail_spool()
+                self._thumbnail = (spool,) + spool.put(data)
+                return data
+        if self._thumbnail is _MISSING:
+            return _MISSING
+        spool, offset, length = self._thumbnail
+        return spool.get(offset, length)
+    
+    def __json__(self):
+        # the thumbnail is encoded as null, don't read it
+        return { k: None if k == 'thumbnail' else self[k] for k in self }
+
+class MetaRecord(_Record):
+    """compact form of a get_meta_data() dict, see compact_meta_data()"""
+    __slots__ = ('file', 'type_description', 'mime_type', 'image')
+    _keys = ('file', 'type_description', 'mime_type', 'image')
+    
+    def __init__(self, file, type_description, image=_MISSING, mime_type=_MISSING):
+        self.file = file
+        self.type_description = type_description
+        # _MISSING in meta data cached before it had a mime type
+        self.mime_type = mime_type
+        self.image = image
+
+def compact_meta_data(meta, spool=None, thumbnail_size=None):
+    """return a MetaRecord of a meta data dict returned by get_meta_data()
+    
+    a MetaRecord is a read-only mapping with the same keys and values as the
+    dict, so it is sorted, grouped and rendered the same way, in a fraction
+    of the memory. the thumbnail is moved to spool, a ThumbnailSpool, or if
+    spool is None, dropped and made again by probe_image() with thumbnail_size
+    when it is read, it is dropped for good if neither is given.
+    other meta data, eg: parts, transformed images or archives, is returned as is.
+    """
+    if isinstance(meta, MetaRecord) or not set(meta) <= {'file', 'type_description', 'mime_type', 'image'}:
+        return meta
+    f = meta['file']
+    if f['name'] != f['path'].rsplit(os.sep, 1)[-1]:
+        return meta
+    description = meta.get('type_description')
+    return MetaRecord(
+        FileRecord(f['path'], f['size'], f['date']['modified'], f['date']['created'], f['hash']),
+        sys.intern(description) if isinstance(description, str) else description,
+        ImageRecord(meta['image'], f['path'], spool, thumbnail_size) if 'image' in meta else _MISSING,
+        sys.intern(meta['mime_type']) if isinstance(meta.get('mime_type'), str) else meta.get('mime_type', _MISSING),
+    )
+
+_EXIF_DATE_RE = re.compile(r'^\d{4}:\d\d:\d\d \d\d:\d\d:\d\d$')
+
+@functools.lru_cache(maxsize=4096)
+def _exif_day(day):
+    """(timestamp of the local midnight of 'YYYY:MM:DD', whether the day has 24 hours), None if not a date"""
     try:
-        import PIL, PIL.Image, PIL.ExifTags
-        try:
-            file = io.BytesIO(meta['file']['data'])
-            with PIL.Image.open(file) as im:
-                # basic image info
-                meta['image'] = {
-                    'format': im.format,
-                    'size'  : im.size,
-                    'mode'  : im.mode,
-                }
-                
-                # image exif
-                if 'exif' in im.info:
-                    exif = {
-                        PIL.ExifTags.TAGS[k]: v
-                        for k, v in im._getexif().items()
-                        if k in PIL.ExifTags.TAGS
-                    }
-                    if 'DateTimeOriginal' in exif:
-                        meta['image']['date'] = exif['DateTimeOriginal']
-                    if 'Model' in exif:
-                        meta['image']['device'] = exif['Model']
-                
-                # image thumbnail, must be last
-                if thumbnail_size is not None and thumbnail_size > 0:
-                    max_w_h = max(meta['image']['size'])
-                    if max_w_h <= thumbnail_size:
-                        resize_size = meta['image']['size']
-                    else:
-                        ratio = thumbnail_size / max_w_h
-                        resize_size = (meta['image']['size'][0] * ratio,
-                                       meta['image']['size'][1] * ratio)
-                    im.thumbnail(resize_size)
-                    buf = io.BytesIO()
-                    im.save(buf, format='JPEG', optimize=True)
-                    meta['image']['thumbnail'] = buf.getvalue()
-        except IOError:
-            pass
-    except ImportError:
-        pass
+        start = datetime.datetime(int(day[0:4]), int(day[5:7]), int(day[8:10]))
+    except ValueError:
+        # eg: '0000:00:00'
+        return None
+    midnight = start.timestamp()
+    return midnight, (start + datetime.timedelta(days=1)).timestamp() - midnight == 86400
+
+@functools.lru_cache(maxsize=1 << 17)
+def _exif_seconds(time):
+    """seconds since midnight of 'HH:MM:SS', None if not a valid time"""
+    hour, minute, second = int(time[0:2]), int(time[3:5]), int(time[6:8])
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    return hour * 3600 + minute * 60 + second
+
+def _exif_timestamp(value):
+    """timestamp of an EXIF date string, None if not a valid date
+    
+    the photos of a batch share a few days, a day without a DST change is
+    its midnight plus the time, much faster than a datetime per string.
+    """
+    day, seconds = _exif_day(value[:10]), _exif_seconds(value[11:])
+    if day is None or seconds is None:
+        return None
+    if day[1]:
+        return day[0] + seconds
+    return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                             seconds // 3600, seconds // 60 % 60, seconds % 60).timestamp()
+
+def sort_value(value):
+    """map a meta data value to a key comparable with any other value
+    
+    missing values < numbers and dates < strings < sequences < others.
+    EXIF date strings are converted to timestamps, so they sort together
+    with the file dates.
+    """
+    if value is _MISSING:
+        return (0,)
+    elif isinstance(value, (int, float)):
+        return (1, value)
+    elif isinstance(value, str):
+        if _EXIF_DATE_RE.match(value):
+            timestamp = _exif_timestamp(value)
+            if timestamp is not None:
+                return (1, timestamp)
+        return (2, value)
+    elif isinstance(value, (tuple, list)):
+        return (3, tuple(map(sort_value, value)))
+    else:
+        return (4, type(value).__name__, repr(value))
+
+def get_path(meta, path):
+    """return the value of a dotted path in meta, eg: 'image.date', or _MISSING
     
-    del meta['file']['data']
+    path may also be a list of keys.
+    """
+    if isinstance(path, str):
+        path = path.split('.')
+    for x in path:
+        try:
+            meta = meta[x]
+        except (KeyError, TypeError, IndexError):
+            return _MISSING
     return meta
 
-def files2meta_data_list(files, thumbnail_size=80, **kwd):
-    return [ get_meta_data(x, thumbnail_size) for x in files ]
-
 def sort_meta_data_list(metas, ordered_by, reverse=False, **kwd):
     """sort a list of meta data
     
+    ordered_by is a dotted path or a list of them, a path prefixed with '-'
+    is sorted in descending order. reverse flips every key.
+    the key of each record is extracted once, see sort_value() for the
+    order of missing values and mixed types.
+    
     eg:
     st_list = sort_meta_data_list(metas, 'image.date', reverse=True)
     st_list = sort_meta_data_list(metas, 'file.name')
+    st_list = sort_meta_data_list(metas, ['image.date', '-file.size'])
     """
-    metas = metas[:]
-    def key_cmp(a, b):
-        def cmp(a, b):
-            if a < b:
-                return -1
-            elif a > b:
-                return 1
+    if isinstance(ordered_by, str):
+        ordered_by = [ordered_by]
+    
+    order = list(range(len(metas)))
+    # the sort is stable, so sort by the last key first
+    for path in reversed(ordered_by):
+        descending = path.startswith('-') != bool(reverse)
+        keys = path.lstrip('-+').split('.')
+        # the key of each distinct string is computed once, eg: the EXIF dates of a burst
+        cache = {}
+        kinds = []
+        column = []
+        for x in metas:
+            value = get_path(x, keys)
+            if isinstance(value, str):
+                key = cache.get(value)
+                if key is None:
+                    key = cache[value] = sort_value(value)
             else:
-                return 0
-            
-        for x in ordered_by.split('.'):
-            if isinstance(a, dict) and x in a:
-                a = a[x]
+                key = sort_value(value)
+            kinds.append(key[0])
+            # numbers and strings sort much faster by themselves than in tuples
+            column.append(key[1] if key[0] in (1, 2) else key)
+        # each kind of value is sorted apart, the kinds in the order of sort_value()
+        parts = collections.defaultdict(list)
+        for i in order:
+            parts[kinds[i]].append(i)
+        order = []
+        for kind in sorted(parts, reverse=descending):
+            if kind != 0:
+                parts[kind].sort(key=column.__getitem__, reverse=descending)
+            order += parts[kind]
+    return [ metas[i] for i in order ]
+
+def base64_size(n):
+    """size of n bytes after base64 transfer encoding, with CRLF every 76 chars"""
+    encoded = (n + 2) // 3 * 4
+    return encoded + (encoded + 75) // 76 * 2
+
+class WireSizeEstimator:
+    """estimate the size of a group's MIME message on the wire
+    
+    the estimate covers the base64 encoding of attachments, the headers of
+    the message and of each part, and the rendered html and text parts.
+    the html and text of a group are rendered per file, so the size of a file
+    can be summed up while packing a group.
+    
+    usage:
+    grps = files2groups(glob('*.JPG'), max_size=10*1024*1024, estimator=WireSizeEstimator())
+    """
+    def __init__(self, html_func=None, text_func=None, header_size=2048, part_header_size=256, margin=4096,
+                 thumbnails='datauri', text_format='json'):
+        # functions rendering a group, group2html() and group2text() by default
+        self.html_func = html_func
+        self.text_func = text_func
+        # message headers, multipart boundaries
+        self.header_size = header_size
+        # Content-Type, Content-Disposition etc. of a part, without the file name
+        self.part_header_size = part_header_size
+        # bytes reserved for estimation errors
+        self.margin = margin
+        # thumbnails mode of group2html() and format of group2text(),
+        # the same as passed to group2Email()
+        self.thumbnails = thumbnails
+        self.text_format = text_format
+        self._empty_size = None
+    
+    def _render(self, grp):
+        """return the wire size of the html and text parts and the inline parts of a group"""
+        text_func = self.text_func or functools.partial(group2text, format=self.text_format)
+        embeddeds = []
+        if self.html_func is not None:
+            html = self.html_func(grp)
+        else:
+            html = group2html(grp, self.thumbnails, embeddeds)
+        return (base64_size(len(html.encode('UTF-8')))
+                + base64_size(len(text_func(grp).encode('UTF-8')))
+                + sum(base64_size(len(data)) + self.part_header_size for data, _, _ in embeddeds))
+    
+    def _empty(self):
+        if self._empty_size is None:
+            self._empty_size = self._render([])
+        return self._empty_size
+    
+    def attachment_size(self, size, file_name=''):
+        """wire size of an attachment part"""
+        return base64_size(size) + self.part_header_size + 2 * len(file_name.encode('UTF-8'))
+    
+    def base_size(self):
+        """wire size of the message of an empty group"""
+        return self.header_size + self.margin + 2 * self.part_header_size + self._empty()
+    
+    def item_size(self, meta):
+        """wire size added to a group's message by a file"""
+        return (self.attachment_size(meta['file']['size'], meta['file']['name'])
+                + self._render([meta]) - self._empty())
+    
+    def group_size(self, grp):
+        """wire size of the message of a group, rendering the whole group"""
+        return (self.header_size + self.margin + 2 * self.part_header_size + self._render(grp)
+                + sum(self.attachment_size(x['file']['size'], x['file']['name']) for x in grp))
+
+PACKING_STRATEGIES = ('next_fit', 'first_fit_decreasing', 'best_fit', 'window')
+
+def pack_sizes(sizes, max_size, base_size=0, packing='next_fit', window=8):
+    """split items into bins, the sizes of each bin plus base_size is smaller than max_size
+    
+    packing:
+    'next_fit'              append to the last bin, open a new bin if the item doesn't fit.
+    'first_fit_decreasing'  put the largest items first, each into the first bin it fits.
+    'best_fit'              put each item into the fullest bin it fits.
+    'window'                next_fit, but before opening a new bin, pull items that fit
+                            from the next `window` items, so the order is mostly kept.
+    
+    every item must fit in an empty bin. return a list of lists of item indices,
+    items in a bin and the bins are in input order.
+    """
+    capacity = max_size - base_size
+    fits = lambda used, size: size + used < capacity
+    bins = []
+    used = []
+    if packing == 'next_fit':
+        for i, size in enumerate(sizes):
+            if bins and fits(used[-1], size):
+                bins[-1].append(i)
+                used[-1] += size
             else:
-                return -1
-            if isinstance(b, dict) and x in b:
-                b = b[x]
+                bins.append([i])
+                used.append(size)
+    elif packing == 'first_fit_decreasing':
+        # max tree of the room left in each bin, bins not opened yet have none,
+        # the first bin with room for an item is found walking down from the root
+        leaves = 1
+        while leaves < len(sizes):
+            leaves *= 2
+        room = [ -math.inf ] * (2 * leaves)
+        for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+            size = sizes[i]
+            if room[1] > size:
+                node = 1
+                while node < leaves:
+                    node = 2 * node if room[2 * node] > size else 2 * node + 1
+                b = node - leaves
+                bins[b].append(i)
+                used[b] += size
             else:
-                return 1
-        return cmp(a, b)
+                b = len(bins)
+                node = b + leaves
+                bins.append([i])
+                used.append(size)
+            room[node] = capacity - used[b]
+            node //= 2
+            while node:
+                room[node] = max(room[2 * node], room[2 * node + 1])
+                node //= 2
+        for x in bins:
+            x.sort()
+        bins.sort()
+    elif packing == 'best_fit':
+        # (used, -bin) of the open bins, sorted: the fullest bin an item fits in
+        # is right before capacity - size, the first bin if several are as full
+        fullness = []
+        for i, size in enumerate(sizes):
+            k = bisect.bisect_left(fullness, (capacity - size,))
+            if k:
+                b = -fullness.pop(k - 1)[1]
+                bins[b].append(i)
+                used[b] += size
+            else:
+                b = len(bins)
+                bins.append([i])
+                used.append(size)
+            bisect.insort(fullness, (used[b], -b))
+    elif packing == 'window':
+        pending = collections.deque(range(len(sizes)))
+        while pending:
+            i = pending.popleft()
+            bins.append([i])
+            total = sizes[i]
+            # scan until window items didn't fit, they stay first for the next bin
+            skipped = []
+            while pending and len(skipped) < window:
+                j = pending.popleft()
+                if fits(total, sizes[j]):
+                    total += sizes[j]
+                    bins[-1].append(j)
+                else:
+                    skipped.append(j)
+            pending.extendleft(reversed(skipped))
+    else:
+        raise ValueError('packing must be one of %s, not %r' % (PACKING_STRATEGIES, packing))
+    return bins
+
+def group_item_sizes(meta_data, estimator=None):
+    """return (base size of a group, list of sizes of each meta data) used for packing"""
+    if estimator is None:
+        return 0, [ x['file']['size'] for x in meta_data ]
+    else:
+        return estimator.base_size(), [ estimator.item_size(x) for x in meta_data ]
+
+def split_file(file_name, part_size, methods=DEFAULT_HASH_METHODS, chunk_size=HASH_CHUNK_SIZE):
+    """hash a file and its parts of part_size bytes in a single pass
+    
+    return (whole file hashes, list of (offset, size, part hashes))
+    """
+    whole = [ hashlib.new(x) for x in methods ]
+    parts = []
+    with open(file_name, 'rb') as f:
+        offset = 0
+        while True:
+            hashers = [ hashlib.new(x) for x in methods ]
+            size = 0
+            while size < part_size:
+                data = f.read(min(chunk_size, part_size - size))
+                if not data:
+                    break
+                size += len(data)
+                for h in hashers + whole:
+                    h.update(data)
+            if size == 0 and parts:
+                break
+            parts.append((offset, size, { x: h.hexdigest() for x, h in zip(methods, hashers) }))
+            offset += size
+            if size < part_size:
+                break
+    return { x: h.hexdigest() for x, h in zip(methods, whole) }, parts
+
+# name of the attachment of a part
+PART_NAME_FMT = '{name}.part{index:03d}of{count:03d}'
+PART_NAME_RE = re.compile(r'^(?P<name>.*)\.part(?P<index>\d+)of(?P<count>\d+)$')
+
+def split_meta_data(meta_data, max_size=45*1024*1024, estimator=None, part_size=None):
+    """replace the meta data of files larger than max_size with meta data of their parts
+    
+    a part is sent as an attachment named PART_NAME_FMT, its meta data is
+    that of the file with the size and hashes of the part, and a 'part' entry:
+    {
+        'name'      : name of the whole file,
+        'index'     : 1-based index of the part,
+        'count'     : number of parts,
+        'offset'    : offset of the part in the file,
+        'file_size' : size of the whole file,
+        'file_hash' : hashes of the whole file,
+    }
+    the text part of the emails (group2text()) is the manifest used by join_parts().
+    
+    part_size: max bytes of a part, the parts fill a group by default.
+    """
+    base_size, sizes = group_item_sizes(meta_data, estimator)
+    capacity = max_size - base_size
+    ret = []
+    for x, size in zip(meta_data, sizes):
+        if size < capacity:
+            ret.append(x)
+            continue
+        
+        def part_meta(offset, size, hashes, index, count):
+            meta = dict(x)
+            meta['file'] = dict(x['file'],
+                                name=PART_NAME_FMT.format(name=x['file']['name'], index=index, count=count),
+                                size=size, hash=hashes)
+            meta['part'] = {
+                'name'      : x['file']['name'],
+                'index'     : index,
+                'count'     : count,
+                'offset'    : offset,
+                'file_size' : x['file']['size'],
+                'file_hash' : x['file']['hash'],
+            }
+            meta.pop('image', None)
+            return meta
+        
+        # largest part fitting in a group
+        count = 999
+        if estimator is None:
+            max_part = capacity - 1
+        else:
+            overhead = estimator.item_size(part_meta(0, 0, x['file']['hash'], count, count))
+            max_part = (capacity - overhead) * 3 * 76 // (4 * 78)
+            while max_part > 0 and estimator.item_size(
+                    part_meta(0, max_part, x['file']['hash'], count, count)) >= capacity:
+                max_part -= 57
+        if part_size is not None:
+            max_part = min(max_part, part_size)
+        if max_part <= 0:
+            raise Exception('file "%s", max_size %d is too small for a part\n' % (x['file']['name'], max_size))
+        
+        methods = list(x['file']['hash']) or DEFAULT_HASH_METHODS
+        file_hash, parts = split_file(x['file']['path'], max_part, methods)
+        if not x['file']['hash']:
+            x = dict(x, file=dict(x['file'], hash=file_hash))
+        for index, (offset, size, hashes) in enumerate(parts, 1):
+            ret.append(part_meta(offset, size, hashes, index, len(parts)))
+    return ret
+
+def join_parts(files, out_dir='.', manifest=None, chunk_size=HASH_CHUNK_SIZE):
+    """rejoin the parts of files from saved attachments, return a list of joined files
+    
+    files: paths of the saved attachments, named by PART_NAME_FMT,
+           other files are ignored.
+    manifest: a list of meta data including the parts, eg: the text parts
+              (group2text()) of the emails, loaded by json.load() and concatenated,
+              or a line each loaded by json.loads() for the 'jsonl' format,
+              or the rows loaded by csv.DictReader() for the 'csv' format.
+              part and whole file hashes are verified if given.
+    
+    an exception is raised when a part is missing or a hash doesn't match.
+    
+    eg:
+    manifest = sum((json.load(open(x)) for x in glob('*.json')), [])
+    join_parts(glob('*.part*of*'), out_dir='joined', manifest=manifest)
+    """
+    expected = {}
+    for x in manifest or []:
+        if x.get('part_name'):
+            # a csv row, the hash columns are named after the hash methods
+            x = {
+                'file': {'name': x['name'], 'hash': { k: x[k] for k in ('md5', 'sha256', 'blake2b') if x.get(k) }},
+                'part': {'file_hash': { k: x['part_file_' + k] for k in ('md5', 'sha256', 'blake2b')
+                                        if x.get('part_file_' + k) }},
+            }
+        if 'part' in x:
+            expected[x['file']['name']] = x
     
-    metas.sort(key=functools.cmp_to_key(key_cmp), reverse=reverse)
-    return metas
+    whole_files = {}
+    for path in files:
+        m = PART_NAME_RE.match(os.path.basename(path))
+        if m is None:
+            continue
+        info = whole_files.setdefault(m.group('name'), {'count': int(m.group('count')), 'parts': {}})
+        info['parts'][int(m.group('index'))] = path
+    
+    joined = []
+    for name, info in sorted(whole_files.items()):
+        missing = sorted(set(range(1, info['count'] + 1)) - set(info['parts']))
+        if missing:
+            raise Exception('file "%s", missing parts %s\n' % (name, missing))
+        
+        first = expected.get(PART_NAME_FMT.format(name=name, index=1, count=info['count']))
+        file_hash = first['part']['file_hash'] if first is not None else {}
+        whole = [ hashlib.new(x) for x in file_hash ]
+        out_path = os.path.join(out_dir, name)
+        with open(out_path, 'wb') as out:
+            for index in range(1, info['count'] + 1):
+                part_name = PART_NAME_FMT.format(name=name, index=index, count=info['count'])
+                part_hash = expected[part_name]['file']['hash'] if part_name in expected else {}
+                hashers = [ hashlib.new(x) for x in part_hash ]
+                with open(info['parts'][index], 'rb') as f:
+                    while True:
+                        data = f.read(chunk_size)
+                        if not data:
+                            break
+                        for h in hashers + whole:
+                            h.update(data)
+                        out.write(data)
+                for method, h in zip(part_hash, hashers):
+                    if h.hexdigest() != part_hash[method]:
+                        raise Exception('part "%s", %s mismatch\n' % (part_name, method))
+        for method, h in zip(file_hash, whole):
+            if h.hexdigest() != file_hash[method]:
+                raise Exception('file "%s", %s mismatch\n' % (name, method))
+        joined.append(out_path)
+    return joined
 
-def meta_data2groups(meta_data=[], max_size=45*1024*1024):
+def meta_data2groups(meta_data=[], max_size=45*1024*1024, estimator=None, packing='next_fit', window=8,
+                     split=False, part_size=None, metrics=None):
     """split a list a meta data into groups(list),
     each group is smaller than max_size.
     
+    estimator: a WireSizeEstimator, max_size is then the size of the encoded
+               message rather than the sum of file sizes.
+    packing, window: the bin packing strategy, see pack_sizes().
+    split: split files exceeding max_size into parts instead of raising,
+           see split_meta_data().
+    part_size: max bytes of a part.
+    metrics: Metrics, a 'group' event is emitted for each group.
+    
     return a list of groups
     """
-    
-    groups = [[]]
-    total_size = 0
-    for x in meta_data:
-        if x['file']['size'] > max_size:
+    if split:
+        meta_data = split_meta_data(meta_data, max_size, estimator, part_size)
+    base_size, sizes = group_item_sizes(meta_data, estimator)
+    for x, size in zip(meta_data, sizes):
+        if size + base_size > max_size:
             raise Exception('file "%s", size %d, exceed max_size %d\n' %
-                            (x['file']['name'], x['file']['size'], max_size))
-        else:
-            if x['file']['size'] + total_size < max_size:
-                # append to last group
-                groups[-1].append(x)
-                total_size += x['file']['size']
-            else:
-                # new group
-                groups.append([x])
-                total_size = x['file']['size']
-    return groups
+                            (x['file']['name'], size, max_size))
+    
+    bins = pack_sizes(sizes, max_size, base_size, packing, window)
+    if metrics is not None:
+        for index, x in enumerate(bins):
+            metrics.emit('group', index=index, files=len(x),
+                         bytes=sum(meta_data[i]['file']['size'] for i in x),
+                         size=base_size + sum(sizes[i] for i in x))
+    return [ [ meta_data[i] for i in x ] for x in bins ] or [[]]
+
+def iter_groups(meta_data, max_size=45*1024*1024, estimator=None, split=False, part_size=None, metrics=None):
+    """online next_fit grouping, yield each group as soon as it is full
+    
+    meta_data can be a generator, eg: iter_meta_data(), the groups are the
+    same as meta_data2groups() with packing='next_fit', see it for the arguments.
+    """
+    base_size = 0 if estimator is None else estimator.base_size()
+    grp = []
+    used = 0
+    index = 0
+    for meta in meta_data:
+        for x in (split_meta_data([meta], max_size, estimator, part_size) if split else [meta]):
+            size = x['file']['size'] if estimator is None else estimator.item_size(x)
+            if size + base_size > max_size:
+                raise Exception('file "%s", size %d, exceed max_size %d\n' %
+                                (x['file']['name'], size, max_size))
+            # the same condition as pack_sizes()
+            if grp and size + used >= max_size - base_size:
+                if metrics is not None:
+                    metrics.emit('group', index=index, files=len(grp),
+                                 bytes=sum(y['file']['size'] for y in grp), size=base_size + used)
+                yield grp
+                index += 1
+                grp = []
+                used = 0
+            grp.append(x)
+            used += size
+    if grp:
+        if metrics is not None:
+            metrics.emit('group', index=index, files=len(grp),
+                         bytes=sum(y['file']['size'] for y in grp), size=base_size + used)
+        yield grp
+
+def packing_report(groups, max_size, estimator=None):
+    """return a dict describing how well groups are packed
+    
+    eg:
+    {
+        'groups'        : 5,
+        'min_groups'    : 4,        # lower bound, ceil(total size / capacity)
+        'fill'          : [0.98, 0.95, 0.97, 0.99, 0.31],
+        'mean_fill'     : 0.84,
+        'total_size'    : 160000000,
+    }
+    """
+    base_size = 0
+    fill = []
+    total = 0
+    for grp in groups:
+        base_size, sizes = group_item_sizes(grp, estimator)
+        total += sum(sizes)
+        fill.append((base_size + sum(sizes)) / max_size)
+    capacity = max_size - base_size
+    return {
+        'groups'        : len(groups),
+        'min_groups'    : -(-total // capacity) if capacity > 0 else None,
+        'fill'          : fill,
+        'mean_fill'     : sum(fill) / len(fill) if fill else None,
+        'total_size'    : total,
+    }
 
-def files2groups(files=[], max_size=45*1024*1024, ordered_by=None, **kwd):
+IMAGE_TRANSFORM_FORMATS = {
+    # format: (extension, mime type)
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'WEBP': ('.webp', 'image/webp'),
+}
+
+def _transform_image(src, digest, hash_methods, cache_dir, max_dimension, format, quality):
+    """downscale and re-encode an image into cache_dir
+    
+    return (path, size, hashes, image size), or None if the image can't be read.
+    """
+    ext = IMAGE_TRANSFORM_FORMATS[format][0]
+    if digest is None:
+        digest = hash_file(src, ('sha256',))['sha256']
+    key = hashlib.sha256(json_encode([digest, max_dimension, format, quality]).encode('UTF-8')).hexdigest()
+    out_path = os.path.join(cache_dir, key + ext)
+    
+    import PIL, PIL.Image
+    if not os.path.exists(out_path):
+        try:
+            with PIL.Image.open(src) as im:
+                exif = im.info.get('exif')
+                # reduced decoding for JPEG
+                im.draft('RGB', (max_dimension, max_dimension))
+                im.thumbnail((max_dimension, max_dimension))
+                if im.mode not in ('RGB', 'L'):
+                    im = im.convert('RGB')
+                tmp_path = '%s.%s.tmp' % (out_path, uuid.uuid4().hex)
+                kwd = { 'quality': quality }
+                if exif:
+                    kwd['exif'] = exif
+                im.save(tmp_path, format=format, **kwd)
+                os.replace(tmp_path, out_path)
+        except IOError:
+            return
+    with PIL.Image.open(out_path) as im:
+        size = im.size
+    return out_path, os.path.getsize(out_path), hash_file(out_path, hash_methods), size
+
+def transform_images(meta_data, max_dimension=2048, format='JPEG', quality=85, cache_dir=None,
+                     workers=None, pool='process', keep_larger=False):
+    """downscale and re-encode images before they are attached
+    
+    each image is resized to fit max_dimension and saved as format (see
+    IMAGE_TRANSFORM_FORMATS) at quality, the exif is kept. the results are
+    cached in cache_dir by the hash of the image and the settings.
+    the images are transformed in parallel, see files2meta_data_list() for
+    workers and pool.
+    
+    return a list of meta data, the 'file' entry of a transformed image
+    describes the new file, the original is in a 'transform' entry:
+    {
+        'source'        : 'file' entry of the original,
+        'max_dimension' : 2048,
+        'format'        : 'JPEG',
+        'quality'       : 85,
+        'mime_type'     : 'image/jpeg',
+        'size'          : (2048, 1536),
+    }
+    images that would not get smaller are left alone unless keep_larger.
+    
+    eg:
+    metas = transform_images(files2meta_data_list(glob('*.JPG')), max_dimension=1600, quality=80)
+    # or
+    files2groups(glob('*.JPG'), transform={'max_dimension': 1600, 'quality': 80})
+    """
+    if format not in IMAGE_TRANSFORM_FORMATS:
+        raise ValueError('format must be one of %s, not %r' % (tuple(IMAGE_TRANSFORM_FORMATS), format))
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'batchmail-images')
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    todo = [ i for i, x in enumerate(meta_data)
+             if 'image' in x and 'part' not in x and 'archive' not in x and 'transform' not in x ]
+    srcs = [ meta_data[i]['file']['path'] for i in todo ]
+    hashes = [ meta_data[i]['file']['hash'] for i in todo ]
+    digests = [ x.get('sha256') or next(iter(x.values()), None) for x in hashes ]
+    methods = [ list(x) or DEFAULT_HASH_METHODS for x in hashes ]
+    func = functools.partial(_transform_image, cache_dir=cache_dir, max_dimension=max_dimension,
+                             format=format, quality=quality)
+    if workers is None or workers <= 1:
+        results = list(map(func, srcs, digests, methods))
+    else:
+        executor = {
+            'process'   : concurrent.futures.ProcessPoolExecutor,
+            'thread'    : concurrent.futures.ThreadPoolExecutor,
+        }[pool]
+        with executor(max_workers=workers) as ex:
+            results = list(ex.map(func, srcs, digests, methods))
+    
+    ret = list(meta_data)
+    ext, mime_type = IMAGE_TRANSFORM_FORMATS[format]
+    for i, result in zip(todo, results):
+        if result is None:
+            continue
+        path, size, hashes, image_size = result
+        x = meta_data[i]
+        if size >= x['file']['size'] and not keep_larger:
+            continue
+        meta = dict(x)
+        meta['file'] = dict(x['file'], name=os.path.splitext(x['file']['name'])[0] + ext,
+                            path=path, size=size, hash=hashes)
+        meta['transform'] = {
+            'source'        : x['file'],
+            'max_dimension' : max_dimension,
+            'format'        : format,
+            'quality'       : quality,
+            'mime_type'     : mime_type,
+            'size'          : image_size,
+        }
+        ret[i] = meta
+    return ret
+
+def files2groups(files=[], max_size=45*1024*1024, ordered_by=None, estimator=None,
+                 packing='next_fit', window=8, split=False, part_size=None, transform=None,
+                 sent_index=None, recipients=None, dedupe=False, metrics=None, **kwd):
     """
     eg:
     # reverse sort photos by the date taken, group them into groups small than 10MB.
     # control the size of thumbnails included in html.
     files2groups(glob('*.JPG'), max_size=10*1000*1000, ordered_by='image.date', reverse=True, thumbnail_size=100)
+    # extract meta data with 4 processes, skip unreadable files
+    files2groups(glob('*.JPG'), workers=4, errors='skip')
+    # max_size is the size of the encoded email
+    files2groups(glob('*.JPG'), max_size=10*1024*1024, estimator=WireSizeEstimator())
+    # fewer, fuller groups, the order of files is kept within 16 files
+    files2groups(glob('*.JPG'), ordered_by='image.date', packing='window', window=16)
+    # send large videos in parts, see join_parts()
+    files2groups(glob('*.MP4'), split=True)
+    # downscale photos, more photos fit in a group
+    files2groups(glob('*.JPG'), transform={'max_dimension': 1600, 'quality': 80, 'workers': 4})
+    # incremental run, skip the photos already sent and the copies of the same photo
+    # recipients are all the addresses sent to, to + cc + bcc, as recorded by send_groups()
+    files2groups(find_files('photos'), sent_index=SentIndex('sent.index'), recipients=['yyy@abc.com', 'zzz@abc.com'])
+    
+    see files2meta_data_list() for the options of meta data extraction,
+    pack_sizes() for the packing strategies, transform_images() for transform,
+    filter_sent() for sent_index and recipients, dedupe leaves out the files with the
+    same content as an earlier one, done anyway with sent_index. Metrics for metrics.
     """
-    metas = files2meta_data_list(files, **kwd)
+    metas = files2meta_data_list(files, metrics=metrics, **kwd)
+    if sent_index is not None or dedupe:
+        metas = filter_sent(metas, sent_index, recipients, dedupe or sent_index is not None, metrics)
+    if transform is not None:
+        metas = transform_images(metas, **transform)
     if ordered_by is not None:
         metas = sort_meta_data_list(metas, ordered_by, **kwd)
-    return meta_data2groups(metas, max_size)
+    return meta_data2groups(metas, max_size, estimator, packing, window, split, part_size, metrics)
 
-def group2html(grp):
-    """generate a html for a group"""
-    def fmt_time(time):
-        fmt = '%Y-%m-%d %H:%M:%S'
-        if isinstance(time, str):
-            # exif time format
-            return datetime.datetime.strptime(time, '%Y:%m:%d %H:%M:%S').strftime(fmt)
-        else:
-            # unix timestamp
-            return datetime.datetime.fromtimestamp(time).strftime(fmt)
-    def datauri(data):
-        return 'data:image/jpeg;base64,'+base64.encodebytes(data).decode(encoding='utf_8')
+ARCHIVE_FORMATS = ('zip', 'tar', 'tar.gz', 'tar.xz', 'tar.zst')
+ARCHIVE_MIME_TYPES = {
+    'zip'       : 'application/zip',
+    'tar'       : 'application/x-tar',
+    'tar.gz'    : 'application/gzip',
+    'tar.xz'    : 'application/x-xz',
+    'tar.zst'   : 'application/zstd',
+}
+
+def _make_archive(out_path, members, format='zip', level=None, hash_methods=DEFAULT_HASH_METHODS):
+    """write files into an archive, return (size, hashes) of the archive
+    
+    members is a list of (path, name in the archive).
+    """
+    if format == 'zip':
+        with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as z:
+            for path, name in members:
+                z.write(path, name)
+    elif format == 'tar.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('tar.zst archives need the zstandard module\n')
+        with open(out_path, 'wb') as f:
+            cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+            with cctx.stream_writer(f) as zf, tarfile.open(fileobj=zf, mode='w|') as tar:
+                for path, name in members:
+                    tar.add(path, name)
+    elif format in ('tar', 'tar.gz', 'tar.xz'):
+        mode = 'w' if format == 'tar' else 'w:' + format.split('.')[1]
+        kwd = {} if level is None or format == 'tar' else \
+              {'compresslevel': level} if format == 'tar.gz' else {'preset': level}
+        with tarfile.open(out_path, mode, **kwd) as tar:
+            for path, name in members:
+                tar.add(path, name)
+    else:
+        raise ValueError('format must be one of %s, not %r' % (ARCHIVE_FORMATS, format))
+    return os.path.getsize(out_path), hash_file(out_path, hash_methods)
+
+def archive_groups(groups, max_size=None, format='zip', small_size=1024*1024, min_files=2,
+                   out_dir=None, name_fmt='batch{num:04d}.{ext}', level=None,
+                   workers=None, pool='process', estimator=None, packing='next_fit', window=8):
+    """pack the small files of each group into an archive
+    
+    this stage sits between files2groups() and groups2Emails(), so a folder of
+    thousands of small files is sent as a few attachments. the archives of
+    the groups are compressed in parallel.
+    
+    max_size: if set, the groups are packed again by the real archive sizes,
+              so groups shrunk by compression are merged. an archive larger
+              than max_size, eg: of incompressible files, is split into several,
+              a file alone too large for an archive is left out of it.
+    format: one of ARCHIVE_FORMATS, 'tar.zst' needs the zstandard module.
+    small_size: files smaller than this are archived.
+    min_files: groups with fewer small files are left as they are.
+    out_dir: where to write the archives, required. it is up to the caller to
+             remove it after sending, eg: a tempfile.TemporaryDirectory().
+    workers, pool: see files2meta_data_list().
+    estimator, packing, window: see meta_data2groups().
+    
+    an archive is in a group as meta data with an 'archive' entry:
+    {
+        'format'    : 'zip',
+        'files'     : [ meta data of the files in the archive ],
+    }
+    group2html() and group2text() list every file in the archive.
+    
+    eg:
+    grps = files2groups(glob('logs/*'), max_size=10*1024*1024)
+    with tempfile.TemporaryDirectory() as tmp:
+        grps = archive_groups(grps, max_size=10*1024*1024, out_dir=tmp, workers=4)
+        send_groups(grps, title='logs', ...)
+    """
+    if format not in ARCHIVE_FORMATS:
+        raise ValueError('format must be one of %s, not %r' % (ARCHIVE_FORMATS, format))
+    if out_dir is None:
+        # a temporary directory would be left behind with a copy of the files
+        raise ValueError('out_dir is required, eg: a tempfile.TemporaryDirectory() removed after sending')
+    
+    # (group index, out path, members, meta data of members)
+    jobs = []
+    for i, grp in enumerate(groups):
+        small = [ x for x in grp if x['file']['size'] < small_size and 'part' not in x ]
+        if len(small) < min_files:
+            continue
+        names = set()
+        members = []
+        for x in small:
+            # unique names in the archive
+            name = x['file']['name']
+            stem, ext = os.path.splitext(name)
+            n = 1
+            while name in names:
+                n += 1
+                name = '%s (%d)%s' % (stem, n, ext)
+            names.add(name)
+            members.append((x['file']['path'], name))
+        out_path = os.path.join(out_dir, name_fmt.format(num=i + 1, ext=format))
+        jobs.append((i, out_path, members, small))
+    
+    hash_methods = next((list(x['file']['hash']) for grp in groups for x in grp if x['file']['hash']),
+                        DEFAULT_HASH_METHODS)
+    func = functools.partial(_make_archive, format=format, level=level, hash_methods=hash_methods)
+    paths = [ x[1] for x in jobs ]
+    members = [ x[2] for x in jobs ]
+    if workers is None or workers <= 1:
+        results = list(map(func, paths, members))
+    else:
+        executor = {
+            'process'   : concurrent.futures.ProcessPoolExecutor,
+            'thread'    : concurrent.futures.ThreadPoolExecutor,
+        }[pool]
+        with executor(max_workers=workers) as ex:
+            results = list(ex.map(func, paths, members))
+    
+    def fitted(out_path, members, small, size, hashes):
+        # the archive, or the archives of its files split to fit in max_size
+        now = time.time()
+        archive = {
+            'file': {
+                'name': os.path.basename(out_path),
+                'path': out_path,
+                'size': size,
+                'date': { 'modified': now, 'created': now },
+                'hash': hashes,
+            },
+            'type_description': '%s archive, %d files, %s' % (
+                format, len(small), sizeof_fmt(sum(x['file']['size'] for x in small))),
+            'mime_type': ARCHIVE_MIME_TYPES[format],
+            'archive': { 'format': format, 'files': small },
+        }
+        if max_size is None:
+            return [archive]
+        base_size, (item_size,) = group_item_sizes([archive], estimator)
+        if item_size + base_size <= max_size:
+            return [archive]
+        os.remove(out_path)
+        if len(small) == 1:
+            return small
+        # the archive headers make it larger than the files
+        count = min(len(small), item_size // max(max_size - base_size, 1) + 2)
+        ret = []
+        for k in range(count):
+            part = slice(k * len(small) // count, (k + 1) * len(small) // count)
+            path = '%s-%d.%s' % (out_path[:-len(format) - 1], k + 1, format)
+            ret.extend(fitted(path, members[part], small[part], *func(path, members[part])))
+        return ret
+    
+    groups = [ list(grp) for grp in groups ]
+    for (i, out_path, members, small), (size, hashes) in zip(jobs, results):
+        archives = fitted(out_path, members, small, size, hashes)
+        archived = set(map(id, small))
+        rest = [ x for x in groups[i] if id(x) not in archived ]
+        groups[i] = archives + rest
+    
+    if max_size is not None:
+        groups = meta_data2groups([ x for grp in groups for x in grp ], max_size, estimator, packing, window)
+    return groups
+
+def expand_archives(grp):
+    """yield meta data of a group, followed by those of the files in each archive
+    
+    the files in an archive get an 'in_archive' entry, the name of the archive.
+    """
+    for x in grp:
+        yield x
+        if 'archive' in x:
+            for y in x['archive']['files']:
+                yield dict(y, in_archive=x['file']['name'])
+
+THUMBNAIL_MODES = ('datauri', 'sprite', 'cid')
+
+def make_sprite(images):
+    """compose JPEG thumbnails into a grid, return (JPEG data, list of (x, y, width, height))"""
+    import PIL, PIL.Image
+    ims = []
+    for data in images:
+        im = PIL.Image.open(io.BytesIO(data))
+        im.load()
+        ims.append(im)
+    # cells aligned to JPEG blocks, so neighbours don't bleed into each other
+    cell_w = -(-max(im.size[0] for im in ims) // 8) * 8
+    cell_h = -(-max(im.size[1] for im in ims) // 8) * 8
+    cols = math.ceil(math.sqrt(len(ims)))
+    rows = -(-len(ims) // cols)
+    sprite = PIL.Image.new('RGB', (cols * cell_w, rows * cell_h), 'white')
+    boxes = []
+    for i, im in enumerate(ims):
+        x, y = i % cols * cell_w, i // cols * cell_h
+        sprite.paste(im.convert('RGB'), (x, y))
+        boxes.append((x, y) + im.size)
+    buf = io.BytesIO()
+    sprite.save(buf, format='JPEG', quality=85, optimize=True)
+    return buf.getvalue(), boxes
+
+def compile_template(template):
+    """compile a str.format() style template into a function writing to a stream
+    
+    the template is parsed once, render(out, fields) writes the text and the
+    fields, looked up by name in the dict fields, in order by out.write().
+    """
+    pieces = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            pieces.append((True, literal))
+        if field is not None:
+            pieces.append((False, field))
     
-    ret = '''<!DOCTYPE html>
+    def render(out, fields):
+        write = out.write
+        for is_literal, x in pieces:
+            write(x if is_literal else fields[x])
+    return render
+
+_HTML_HEAD = '''<!DOCTYPE html>
     <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
     <style>
         html {
@@ -463,9 +3274,9 @@ def group2html(grp):
         
     </style>
 '''
-    for i, x in enumerate(grp):
-        table = '''
-    # '''+str(i)+'''
+
+_HTML_FILE = compile_template('''
+    # {index}
     <table cellspacing="0" cellpadding="0">
         <tr>
             <td>
@@ -474,85 +3285,251 @@ def group2html(grp):
                         <th colspan="4">File</th>
                     </tr>
                     <tr>
-                        <th>Name</th>       <td>'''+html.escape(x['file']['name'])+'''</td>
-                        <th>Size</th>       <td>'''+(('%d (%s)'
-                                                      % (x['file']['size'], sizeof_fmt(x['file']['size'])))
-                                                      if x['file']['size'] > 1024
-                                                      else str(x['file']['size']))+'''</td>
-                    </tr>
-                    <tr>
-                        <th>Created</th>    <td>'''+fmt_time(x['file']['date']['created'])+'''</td>
-                        <th>Modified</th>   <td>'''+fmt_time(x['file']['date']['modified'])+'''</td>
+                        <th>Name</th>       <td>{name}</td>
+                        <th>Size</th>       <td>{size}</td>
                     </tr>
                     <tr>
-                        <th>md5</th>        <td colspan="3">'''+x['file']['hash']['md5']+'''</td>
-                    </tr>
-                    <tr>
-                        <th>sha256</th>     <td colspan="3">'''+x['file']['hash']['sha256']+'''</td>
+                        <th>Created</th>    <td>{created}</td>
+                        <th>Modified</th>   <td>{modified}</td>
                     </tr>
+{rows}
                     <tr>
                         <th>Type</th>       <td colspan="3"><label><input type="checkbox" />
-                                                <div class="detail">'''+(html.escape(x['type_description'])
-                                                                         if x['type_description'] is not None
-                                                                         else 'N/A')+'''
+                                                <div class="detail">{type}
                                                 </div></lable>
                                             </td>
                     </tr>
                 </table>
             </td>
-'''
-        if 'image' in x:
-            table +='''
+''')
+
+_HTML_ROW = '''
+                    <tr>
+                        <th>%s</th>%s<td colspan="3">%s</td>
+                    </tr>'''
+
+_HTML_IMAGE = compile_template('''
             <td valign="top">
                 <table>
                     <tr>
                         <!-- data:image/jpeg;base64,AAABAA... -->
-                        '''+(('<td rowspan="4"><img src="'+datauri(x['image']['thumbnail'])+'" /></td>')
-                             if 'thumbnail' in x['image']
-                             else '')+'''
+                        {thumbnail}
                         <th colspan="4">Image</th>
                     </tr>
                     <tr>
-                        <th>Date</th>      <td>'''+(fmt_time(x['image']['date'])
-                                                    if 'date' in x['image']
-                                                    else 'N/A')+'''</td>
-                        <th>Size</th>      <td>'''+('%dx%d' % x['image']['size'])+'''</td>
+                        <th>Date</th>      <td>{date}</td>
+                        <th>Size</th>      <td>{size}</td>
                     </tr>
                     <tr>
-                        <th>Format</th>    <td>'''+html.escape(x['image']['format'])+'''</td>
-                        <th>Mode</th>      <td>'''+html.escape(x['image']['mode'])+'''</td>
+                        <th>Format</th>    <td>{format}</td>
+                        <th>Mode</th>      <td>{mode}</td>
                     </tr>
                     <tr>
-                        <th>Device</th>    <td>'''+(html.escape(x['image']['device'])
-                                                    if 'device' in x['image']
-                                                    else 'N/A')+'''</td>
+                        <th>Device</th>    <td>{device}</td>
                     </tr>
                 </table>
             </td>
-'''
-        table += '''
+''')
+
+_HTML_FILE_END = '''
         </tr>
     </table>
     <br />
 '''
-        ret += table
-        
-    ret += '''
+
+_HTML_FOOT = compile_template('''
     <hr />
-    '''+('%d files, %s.' % (len(grp), sizeof_fmt(sum(x['file']['size'] for x in grp))))+'''
-</html>'''
-    return ret
+    {summary}
+</html>''')
+
+def group2html(grp, thumbnails='datauri', embeddeds=None):
+    """generate a html for a group
+    
+    thumbnails:
+    'datauri'   each thumbnail is inlined as a data: URI.
+    'sprite'    the thumbnails are composed into one image, attached once
+                as an inline part and shown with CSS offsets.
+                falls back to 'cid' if PIL is missing.
+    'cid'       each thumbnail is an inline part referenced by cid:.
+    embeddeds: a list, the inline parts referenced by the html are appended to it
+               as (data, mime type, content id), see Email.embeddeds.
+    """
+    out = io.StringIO()
+    write_group_html(grp, out, thumbnails, embeddeds)
+    return out.getvalue()
+
+def write_group_html(grp, out, thumbnails='datauri', embeddeds=None):
+    """write the html of a group to a text stream, see group2html()"""
+    if thumbnails not in THUMBNAIL_MODES:
+        raise ValueError('thumbnails must be one of %s, not %r' % (THUMBNAIL_MODES, thumbnails))
+    if embeddeds is None:
+        if thumbnails != 'datauri':
+            raise ValueError('embeddeds is required for thumbnails=%r' % thumbnails)
+        embeddeds = []
+    def fmt_time(time):
+        fmt = '%Y-%m-%d %H:%M:%S'
+        if isinstance(time, str):
+            # exif time format
+            try:
+                return datetime.datetime.strptime(time, '%Y:%m:%d %H:%M:%S').strftime(fmt)
+            except ValueError:
+                return html.escape(time)
+        else:
+            # unix timestamp
+            return datetime.datetime.fromtimestamp(time).strftime(fmt)
+    def datauri(data):
+        return 'data:image/jpeg;base64,'+base64.encodebytes(data).decode(encoding='utf_8')
+    
+    # html of each thumbnail, by index in expand_archives(grp)
+    thumbs = [ (i, x['image'].get('thumbnail')) for i, x in enumerate(expand_archives(grp))
+               if 'image' in x and 'thumbnail' in x['image'] ]
+    # eg: a compact record whose thumbnail could not be made again
+    thumbs = [ (i, data) for i, data in thumbs if data is not None ]
+    thumb_html = {}
+    group_id = uuid.uuid4().hex
+    if thumbnails == 'sprite' and thumbs:
+        try:
+            sprite, boxes = make_sprite([ data for _, data in thumbs ])
+        except ImportError:
+            thumbnails = 'cid'
+        else:
+            cid = 'sprite.%s@batchmail' % group_id
+            embeddeds.append((sprite, 'image/jpeg', cid))
+            for (i, _), (x, y, w, h) in zip(thumbs, boxes):
+                thumb_html[i] = ('<div style="width: %dpx; height: %dpx; '
+                                 'background: url(cid:%s) -%dpx -%dpx no-repeat;"></div>' % (w, h, cid, x, y))
+    if thumbnails == 'cid':
+        for i, data in thumbs:
+            cid = 'thumb%d.%s@batchmail' % (i, group_id)
+            embeddeds.append((data, 'image/jpeg', cid))
+            thumb_html[i] = '<img src="cid:%s" />' % cid
+    elif thumbnails == 'datauri':
+        for i, data in thumbs:
+            thumb_html[i] = '<img src="%s" />' % datauri(data)
+    
+    out.write(_HTML_HEAD)
+    for i, x in enumerate(expand_archives(grp)):
+        rows = [ _HTML_ROW % (html.escape(method), '   ', digest)
+                 for method, digest in x['file']['hash'].items() ]
+        if 'part' in x:
+            rows.append(_HTML_ROW % ('Part', '       ', '%d/%d of %s, offset %d, size %d'
+                                     % (x['part']['index'], x['part']['count'], html.escape(x['part']['name']),
+                                        x['part']['offset'], x['part']['file_size'])))
+            rows.extend(_HTML_ROW % (html.escape(method), '   ', digest + ' (whole file)')
+                        for method, digest in x['part']['file_hash'].items())
+        if 'in_archive' in x:
+            rows.append(_HTML_ROW % ('Archive', '    ', html.escape(x['in_archive'])))
+        
+        size = x['file']['size']
+        _HTML_FILE(out, {
+            'index'     : str(i),
+            'name'      : html.escape(x['file']['name']),
+            'size'      : ('%d (%s)' % (size, sizeof_fmt(size))) if size > 1024 else str(size),
+            'created'   : fmt_time(x['file']['date']['created']),
+            'modified'  : fmt_time(x['file']['date']['modified']),
+            'rows'      : ''.join(rows),
+            'type'      : (html.escape(x['type_description'])
+                           if x.get('type_description') is not None
+                           else 'N/A'),
+        })
+        if 'image' in x:
+            image = x['image']
+            _HTML_IMAGE(out, {
+                'thumbnail' : ('<td rowspan="4">' + thumb_html[i] + '</td>') if i in thumb_html else '',
+                'date'      : fmt_time(image['date']) if 'date' in image else 'N/A',
+                'size'      : '%dx%d' % tuple(image['size']),
+                'format'    : html.escape(image['format']),
+                'mode'      : html.escape(image['mode']),
+                'device'    : html.escape(image['device']) if 'device' in image else 'N/A',
+            })
+        out.write(_HTML_FILE_END)
+    
+    _HTML_FOOT(out, {
+        'summary': '%d files, %s.' % (sum(len(x['archive']['files']) if 'archive' in x else 1 for x in grp),
+                                      sizeof_fmt(sum(x['file']['size'] for x in grp))),
+    })
+
+TEXT_FORMATS = ('json', 'jsonl', 'csv')
 
-def group2text(grp):
-    return json_encode([x for x in grp], indent=4)
+# columns of the 'csv' text format, (title, dotted path in meta data)
+TEXT_CSV_COLUMNS = (
+    ('path', 'file.path'), ('name', 'file.name'), ('size', 'file.size'),
+    ('modified', 'file.date.modified'), ('created', 'file.date.created'),
+    ('md5', 'file.hash.md5'), ('sha256', 'file.hash.sha256'), ('blake2b', 'file.hash.blake2b'),
+    ('type', 'type_description'), ('mime_type', 'mime_type'), ('image_date', 'image.date'), ('image_device', 'image.device'),
+    ('part_name', 'part.name'), ('part_index', 'part.index'), ('part_count', 'part.count'),
+    ('part_offset', 'part.offset'), ('part_file_size', 'part.file_size'),
+    ('part_file_md5', 'part.file_hash.md5'), ('part_file_sha256', 'part.file_hash.sha256'),
+    ('part_file_blake2b', 'part.file_hash.blake2b'), ('in_archive', 'in_archive'),
+)
+
+def group2text(grp, format='json'):
+    """generate the text part for a group
+    
+    format:
+    'json'  the meta data of the group, indented.
+    'jsonl' a compact JSON line per file, files in archives have their own lines.
+    'csv'   a line per file, the columns are TEXT_CSV_COLUMNS.
+    """
+    out = io.StringIO()
+    write_group_text(grp, out, format)
+    return out.getvalue()
 #     return 'See html part of this email.'
 
-def group2Email(grp, subject=None, **kwd):
+def write_group_text(grp, out, format='json'):
+    """write the text part for a group to a text stream, see group2text()"""
+    if format == 'json':
+        for chunk in JSONEncoder(ensure_ascii=False, indent=4).iterencode([x for x in grp]):
+            out.write(chunk)
+    elif format == 'jsonl':
+        for x in expand_archives(grp):
+            x = dict(x)
+            x.pop('archive', None)
+            if 'image' in x:
+                x['image'] = { k: x['image'][k] for k in x['image'] if k != 'thumbnail' }
+            out.write(json_encode(x, separators=(',', ':')))
+            out.write('\n')
+    elif format == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow([ title for title, _ in TEXT_CSV_COLUMNS ])
+        for x in expand_archives(grp):
+            row = []
+            for _, path in TEXT_CSV_COLUMNS:
+                value = get_path(x, path)
+                row.append('' if value is _MISSING or value is None else value)
+            writer.writerow(row)
+    else:
+        raise ValueError('format must be one of %s, not %r' % (TEXT_FORMATS, format))
+
+def meta2attachment(meta):
+    """return the attachment of a file in Email.attachments"""
+    if 'part' in meta:
+        return {
+            'path'  : meta['file']['path'],
+            'offset': meta['part']['offset'],
+            'size'  : meta['file']['size'],
+            'name'  : meta['file']['name'],
+        }
+    elif 'transform' in meta:
+        return {
+            'path'      : meta['file']['path'],
+            'name'      : meta['file']['name'],
+            'mime_type' : meta['transform']['mime_type'],
+        }
+    elif meta.get('mime_type'):
+        # typed by get_meta_data(), not again when the email is made
+        return { 'path': meta['file']['path'], 'mime_type': meta['mime_type'] }
+    else:
+        return meta['file']['path']
+
+def group2Email(grp, subject=None, thumbnails='datauri', text_format='json', **kwd):
+    """return an Email of a group, see group2html() for thumbnails, group2text() for text_format"""
     eml = Email(**kwd)
     eml.subject = subject
-    eml.text = group2text(grp)
-    eml.html = group2html(grp)
-    eml.attachments = [ x['file']['path'] for x in grp ]
+    eml.text = group2text(grp, text_format)
+    eml.embeddeds = []
+    eml.html = group2html(grp, thumbnails, eml.embeddeds)
+    eml.attachments = [ meta2attachment(x) for x in grp ]
     
     return eml
 
@@ -581,18 +3558,26 @@ def groups2subjects(groups, title='batch mailer',
     progress_tup = (0, 0)
     for i, grp in enumerate(groups):
         progress_tup = (progress_tup[1]+1, progress_tup[1]+len(grp))
-        att_size = sum(x['file']['size'] for x in grp)
-        this_subject = subject_fmt.format(title=title, num=i+1, total=total, size=sizeof_fmt(att_size),
-                                      progress=('%d-%d' % progress_tup))
-        subjects.append(this_subject)
+        subjects.append(group_subject(grp, i+1, progress_tup, total, title, subject_fmt))
         
     return subjects
 
+def group_subject(grp, num, progress_tup, total, title='batch mailer',
+                  subject_fmt='{title} #{num} ({progress}/{total}) {size}', **kwd):
+    """return the subject of a group, see groups2subjects()"""
+    att_size = sum(x['file']['size'] for x in grp)
+    return subject_fmt.format(title=title, num=num, total=total, size=sizeof_fmt(att_size),
+                              progress=('%d-%d' % progress_tup))
+
 def groups2Emails(groups, **kwd):
     """return a list of Email instances from a list of groups
     
     eg:
     emails = groups2Emails(groups, title='hahaha', from_='xxx@abc.com', to=['yyy@ddd.com'], smtp='mail.abc.com')
+    # or share one smtp connection among the emails
+    emails = groups2Emails(groups, title='hahaha', ..., smtp_pool=SMTPPool())
+    # a Metrics gets a 'render' event for each email
+    emails = groups2Emails(groups, title='hahaha', ..., metrics=Metrics())
     passwd = input('your password')
     for eml in emails:
         eml.password = passwd
@@ -600,27 +3585,549 @@ def groups2Emails(groups, **kwd):
         ......
         eml.send()
     """
-    subjects = groups2subjects(groups, **kwd)
-    emails = []
+    # number the subjects over the whole batch
+    total = sum(len(x) for x in groups)
+    return [ eml for _, eml in iter_groups2Emails(groups, total, **kwd) ]
+
+def iter_groups2Emails(groups, total='?', metrics=None, **kwd):
+    """yield (group, Email) for groups, see groups2Emails()
+    
+    groups can be a generator, eg: iter_groups(), total is then unknown
+    and shown as '?' in the subjects.
+    """
+    progress_tup = (0, 0)
     for i, grp in enumerate(groups):
-        eml = group2Email(grp, subject=subjects[i], **kwd)
-        emails.append(eml)
-    return emails
+        t0 = time.perf_counter()
+        progress_tup = (progress_tup[1]+1, progress_tup[1]+len(grp))
+        eml = group2Email(grp, subject=group_subject(grp, i+1, progress_tup, total, **kwd), **kwd)
+        if metrics is not None:
+            metrics.emit('render', index=i, seconds=time.perf_counter() - t0,
+                         html_bytes=len(eml.html.encode('UTF-8')), text_bytes=len(eml.text.encode('UTF-8')))
+        yield grp, eml
+
+
+class SendJournal:
+    """durable record of the groups of a batch and their delivery state, backed by sqlite
+    
+    a group is identified by the hashes of its files and the recipients,
+    so the same grouping of the same files maps to the same records
+    when a batch is run again.
+    the state of a group is 'pending', 'sent' or 'failed'.
+    
+    usage:
+    with SendJournal('photos.journal') as journal:
+        results = send_groups(grps, journal=journal, title='Some photos', ...)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS groups (
+                key         TEXT PRIMARY KEY,
+                members     TEXT,
+                recipients  TEXT,
+                subject     TEXT,
+                state       TEXT,
+                attempts    INTEGER,
+                error       TEXT,
+                updated     REAL
+            );
+        ''')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+    
+    @staticmethod
+    def member_files(grp):
+        """return the meta data of the files of a group, those in archives instead of the archives"""
+        # archives are rebuilt on each run, identify them by their files
+        return [ y for x in grp for y in (x['archive']['files'] if 'archive' in x else [x]) ]
+    
+    @staticmethod
+    def members(grp):
+        """return a list identifying the files of a group by their hashes"""
+        return [ content_digest(x) for x in SendJournal.member_files(grp) ]
+    
+    @staticmethod
+    def group_key(grp, recipients):
+        js = json_encode([SendJournal.members(grp), sorted(recipients)])
+        return hashlib.sha256(js.encode('UTF-8')).hexdigest()
+    
+    def state(self, key):
+        """return the state of a group, None if unknown"""
+        with self._lock:
+            row = self._db.execute('SELECT state FROM groups WHERE key=?', (key,)).fetchone()
+        return None if row is None else row[0]
+    
+    def record(self, key, state, grp=None, recipients=None, subject=None, error=None, attempts=0):
+        """update the state of a group and commit"""
+        with self._lock:
+            self._db.execute('''
+                INSERT INTO groups VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state=excluded.state, error=excluded.error, updated=excluded.updated,
+                    attempts=groups.attempts + excluded.attempts
+            ''', (key,
+                  None if grp is None else json_encode([ (content_digest(x), x['file']['path'])
+                                                         for x in SendJournal.member_files(grp) ]),
+                  None if recipients is None else json_encode(recipients),
+                  subject, state, attempts, error, time.time()))
+            self._db.commit()
+    
+    def report(self):
+        """return a dict of state -> number of groups"""
+        with self._lock:
+            return dict(self._db.execute('SELECT state, COUNT(*) FROM groups GROUP BY state'))
+
+def _pick_digest(hashes):
+    return hashes.get('sha256') or next(iter(hashes.values()), None)
+
+def content_digest(meta):
+    """return a str identifying the content of a file by its meta data
+    
+    the sha256 if computed, otherwise the first digest, or the path, size and
+    mtime when hashing was skipped. a transformed image is identified by its
+    source, a part of a file by the part.
+    """
+    digest = _pick_digest((meta['transform']['source'] if 'transform' in meta else meta['file']).get('hash') or {})
+    if digest is None:
+        digest = '%s:%d:%s' % (meta['file']['path'], meta['file']['size'], meta['file']['date']['modified'])
+    return digest
+
+class SentIndex:
+    """persistent index of the file contents delivered to each set of recipients, backed by sqlite
+    
+    files are identified by content_digest(), so a renamed or moved file is
+    still known. a split file is known when all of its parts are delivered,
+    counted by part index, so parts with the same content count separately.
+    the recipients are all the addresses of the messages, to + cc + bcc as
+    given by Email.to_addr(), in any order and case, see recipients_key().
+    
+    usage:
+    with SentIndex('sent.index') as index:
+        to, cc = ['yyy@abc.com'], ['zzz@abc.com']
+        grps = files2groups(find_files('photos'), sent_index=index, recipients=to + cc)
+        send_groups(grps, sent_index=index, to=to, cc=cc, ...)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS sent (
+                digest      TEXT,
+                recipients  TEXT,
+                path        TEXT,
+                size        INTEGER,
+                part_of     TEXT,
+                sent        REAL,
+                PRIMARY KEY (digest, recipients)
+            );
+            CREATE INDEX IF NOT EXISTS sent_part_of ON sent (part_of, recipients);
+            CREATE TABLE IF NOT EXISTS sent_parts (
+                part_of     TEXT,
+                recipients  TEXT,
+                part        INTEGER,
+                sent        REAL,
+                PRIMARY KEY (part_of, recipients, part)
+            );
+        ''')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+    
+    @staticmethod
+    def recipients_key(recipients):
+        """the set of addresses, eg: ('Yyy', 'YYY@abc.com') and 'yyy@abc.com ' are the same"""
+        return json_encode(sorted(set(Email._get_addr(x).strip().lower() for x in recipients)))
+    
+    def sent_digests(self, recipients):
+        """return the set of digests delivered to recipients"""
+        with self._lock:
+            return set(x for x, in self._db.execute('SELECT digest FROM sent WHERE recipients=?',
+                                                    (SentIndex.recipients_key(recipients),)))
+    
+    def add(self, grp, recipients):
+        """record the files of a delivered group and commit"""
+        key = SentIndex.recipients_key(recipients)
+        now = time.time()
+        with self._lock:
+            for x in expand_archives(grp):
+                if 'archive' in x:
+                    continue
+                digest = content_digest(x)
+                part_of = None
+                if 'part' in x:
+                    part_of = _pick_digest(x['part']['file_hash'])
+                self._db.execute('INSERT OR IGNORE INTO sent VALUES (?, ?, ?, ?, ?, ?)',
+                                 (digest, key, x['file']['path'], x['file']['size'], part_of, now))
+                if part_of is not None:
+                    # parts are counted by index, parts with the same content are one row of sent
+                    self._db.execute('INSERT OR IGNORE INTO sent_parts VALUES (?, ?, ?, ?)',
+                                     (part_of, key, x['part']['index'], now))
+                    count, = self._db.execute('SELECT COUNT(*) FROM sent_parts WHERE part_of=? AND recipients=?',
+                                              (part_of, key)).fetchone()
+                    if count >= x['part']['count']:
+                        self._db.execute('INSERT OR IGNORE INTO sent VALUES (?, ?, ?, ?, NULL, ?)',
+                                         (part_of, key, x['file']['path'], x['part']['file_size'], now))
+            self._db.commit()
+    
+    def report(self):
+        """return a dict of (recipient, ...) -> (number of files, bytes)"""
+        with self._lock:
+            return { tuple(json.loads(key)): (n, size) for key, n, size in self._db.execute(
+                'SELECT recipients, COUNT(*), SUM(size) FROM sent WHERE part_of IS NULL GROUP BY recipients') }
+
+def filter_sent(meta_data, sent_index=None, recipients=None, duplicates=True, metrics=None):
+    """return the meta data of the files to send, in order, see iter_filter_sent()"""
+    return list(iter_filter_sent(meta_data, sent_index, recipients, duplicates, metrics))
+
+def iter_filter_sent(meta_data, sent_index=None, recipients=None, duplicates=True, metrics=None):
+    """yield the meta data of the files to send, in order
+    
+    sent_index, recipients: leave out the files sent_index has as delivered to recipients,
+                            all the addresses sent to: to + cc + bcc, see SentIndex.
+    duplicates: leave out the files with the same content as an earlier one in meta_data.
+    metrics: Metrics, a 'skip' event with path, size and reason ('sent' or 'duplicate')
+             is emitted for each file left out.
+    """
+    sent = set()
+    if sent_index is not None:
+        if recipients is None:
+            raise ValueError('recipients is required with sent_index')
+        sent = sent_index.sent_digests(recipients)
+    seen = set()
+    for x in meta_data:
+        digest = content_digest(x)
+        reason = None
+        if digest in sent:
+            reason = 'sent'
+        elif duplicates and digest in seen:
+            reason = 'duplicate'
+        if reason is None:
+            seen.add(digest)
+            yield x
+        elif metrics is not None:
+            metrics.emit('skip', path=x['file']['path'], size=x['file']['size'], reason=reason)
+
+def send_groups(groups, journal=None, resume=True, retries=5, backoff=1.0, max_backoff=300,
+                on_result=None, sent_index=None, fanout=None, **kwd):
+    """send groups by send_emails(), recording the progress in a SendJournal
+    
+    groups: a list, or a generator, eg: iter_groups(), the emails are then
+            made and sent as the groups come.
+    resume: skip the groups the journal has as sent.
+    sent_index: a SentIndex, the files of each group accepted for all recipients are added to it,
+                the recipients are Email.to_addr(), to + cc + bcc.
+    fanout: send each group as a separate message to batches of fanout recipients,
+            see Email.fanout(). the journal records each batch.
+    retries, backoff, max_backoff: retry of transient smtp errors, see send_emails().
+    the other keyword arguments are passed to groups2Emails() and send_emails(),
+    eg: block_cache=EncodedBlockCache() to share the encoded attachments.
+    
+    return the results of send_emails() for the groups sent in this run.
+    
+    eg:
+    # rerunning after a failure only sends the remaining groups,
+    # a MetaDataCache makes the rescan cheap.
+    with SendJournal('photos.journal') as journal, MetaDataCache('photos.cache') as cache:
+        grps = files2groups(glob('*.JPG'), ordered_by='image.date', cache=cache)
+        send_groups(grps, journal=journal, title='Some photos', from_='xxx@abc.com', to=['yyy@ddd.com'],
+                    smtp='mail.abc.com', password=passwd)
+    """
+    send_kwd = {
+        x: kwd.pop(x) for x in ('workers', 'rate_limits', 'default_rate_limit', 'streaming', 'accounts')
+        if x in kwd
+    }
+    if 'metrics' in kwd:
+        send_kwd['metrics'] = kwd['metrics']
+    if isinstance(groups, (list, tuple)):
+        # number the subjects over the whole batch
+        pairs = iter_groups2Emails(groups, sum(len(x) for x in groups), **kwd)
+    else:
+        pairs = iter_groups2Emails(groups, **kwd)
+    
+    keys = {}
+    sent_groups = {}
+    sent_lock = threading.Lock()
+    
+    def done(eml, ok):
+        # the group is delivered when the messages to all of its recipients are
+        grp, orig, counts = sent_groups.pop(id(eml))
+        with sent_lock:
+            counts['left'] -= 1
+            counts['failed'] += not ok
+            finished = counts['left'] == 0
+        if finished:
+            if sent_index is not None and not counts['failed']:
+                sent_index.add(grp, orig.to_addr())
+            if orig.body is not None:
+                orig.body.close()
+    
+    def pending():
+        for grp, eml in pairs:
+            if not grp:
+                # eg: every file was filtered out by filter_sent()
+                continue
+            eml.normalize()
+            # the body is built when the first copy not yet sent is
+            emls = eml.fanout(batch_size=fanout, metrics=kwd.get('metrics')) if fanout else [eml]
+            counts = {'left': len(emls), 'failed': 0}
+            for eml_ in emls:
+                sent_groups[id(eml_)] = (grp, eml, counts)
+                if journal is not None:
+                    recipients = eml_.to_addr()
+                    key = SendJournal.group_key(grp, recipients)
+                    if resume and journal.state(key) == 'sent':
+                        done(eml_, True)
+                        continue
+                    journal.record(key, 'pending', grp, recipients, eml_.subject)
+                    keys[id(eml_)] = key
+                yield eml_
+    
+    def record(result):
+        if journal is not None:
+            # the message is accepted when the result is a dict, even if some recipients are refused
+            state = 'sent' if isinstance(result['result'], dict) else 'failed'
+            error = None
+            if result['error'] is not None:
+                error = repr(result['error'])
+            elif result['result']:
+                error = json_encode(result['result'], default=str)
+            journal.record(keys[id(result['email'])], state, error=error, attempts=result['attempts'])
+        done(result['email'], result['ok'])
+        if on_result is not None:
+            on_result(result)
+    
+    return send_emails(pending(), smtp_pool=kwd.get('smtp_pool'), on_result=record,
+                       retries=retries, backoff=backoff, max_backoff=max_backoff, **send_kwd)
+
+
+def iter_prefetch(iterable, maxsize=1):
+    """iterate iterable in a background thread, keeping up to maxsize items ahead
+    
+    a bounded queue between two generator stages, so each stage runs while
+    the next one is busy. an exception of iterable is raised to the consumer.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    end = object()
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for x in iterable:
+                if not put((x, None)):
+                    return
+            put((end, None))
+        except BaseException as e:
+            put((end, e))
+    
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            x, exc = items.get()
+            if x is end:
+                if exc is not None:
+                    raise exc
+                return
+            yield x
+    finally:
+        # the consumer stopped early, let the producer finish
+        stop.set()
+
+def send_pipeline(paths, max_size=45*1024*1024, include=None, exclude=None, recursive=True,
+                  meta_workers=None, meta_pool='process', cache=None, estimator=None, split=False, part_size=None,
+                  sent_index=None, dedupe=False, queue_size=4, metrics=None, **kwd):
+    """find, extract meta data, group and send files as a pipeline
+    
+    each stage is a generator, the stages are connected by bounded queues
+    (iter_prefetch()) and the groups are made online (iter_groups()), so the
+    first emails are sent while later files are still found and hashed.
+    the files are grouped in the order they are found, not sorted.
+    
+    paths, include, exclude, recursive: see iter_files().
+    meta_workers, meta_pool, cache: workers, pool and cache of iter_meta_data().
+    estimator, split, part_size: see meta_data2groups().
+    sent_index, dedupe: see filter_sent(), the recipients are taken from to, cc and bcc.
+    queue_size: number of items buffered between the stages.
+    the other keyword arguments are passed to send_groups(), eg: journal, workers, streaming.
+    
+    eg:
+    with MetaDataCache('photos.cache') as cache, SendJournal('photos.journal') as journal:
+        results = send_pipeline('photos', max_size=10*1024*1024, meta_workers=4, cache=cache,
+                                journal=journal, title='Some photos', from_='xxx@abc.com',
+                                to=['yyy@ddd.com'], smtp='mail.abc.com', password=passwd)
+    """
+    files = iter_prefetch(iter_files(paths, include, exclude, recursive), queue_size * 64)
+    metas = iter_meta_data(files, workers=meta_workers, pool=meta_pool, cache=cache, metrics=metrics,
+                           **{ x: kwd.pop(x) for x in ('thumbnail_size', 'hash_methods', 'errors', 'on_error', 'compact')
+                               if x in kwd })
+    if sent_index is not None or dedupe:
+        recipients = None
+        if sent_index is not None:
+            eml = Email(**kwd)
+            eml.normalize()
+            recipients = eml.to_addr()
+        metas = iter_filter_sent(metas, sent_index, recipients, True, metrics)
+    groups = iter_prefetch(iter_groups(metas, max_size, estimator, split, part_size, metrics), queue_size)
+    return send_groups(groups, sent_index=sent_index, metrics=metrics, **kwd)
+
+
+def main(argv=None):
+    """command line interface, see `python batchmail.py --help`"""
+    parser = argparse.ArgumentParser(description='send files by email in groups')
+    parser.add_argument('paths', nargs='+', help='files and directories to send')
+    parser.add_argument('--from', dest='from_', required=True, help='sender address')
+    parser.add_argument('--to', action='append', default=[], help='recipient, repeatable, the sender by default')
+    parser.add_argument('--cc', action='append', default=[])
+    parser.add_argument('--bcc', action='append', default=[])
+    parser.add_argument('--smtp', help='HOST[:PORT], smtp.<sender domain> by default')
+    parser.add_argument('--mode', default='tls', choices=('normal', 'ssl', 'tls'))
+    parser.add_argument('--user', help='smtp account, the sender by default if a password is used')
+    parser.add_argument('--password-env', metavar='VAR',
+                        help='read the password from this environment variable instead of a prompt')
+    parser.add_argument('--no-auth', action='store_true', help='do not log in')
+    parser.add_argument('--title', default='batch mailer', help='subject title')
+    parser.add_argument('--max-size', type=float, default=45, help='max size of an email in MiB')
+    parser.add_argument('--include', action='append', help='file name pattern, repeatable')
+    parser.add_argument('--exclude', action='append', help='file or directory name pattern, repeatable')
+    parser.add_argument('--no-recursive', action='store_true')
+    parser.add_argument('--ordered-by', action='append',
+                        help='sort key, eg: image.date or --ordered-by=-file.size, repeatable. '
+                             'the files are then all scanned before sending')
+    parser.add_argument('--estimate', action='store_true', help='max size is of the encoded email')
+    parser.add_argument('--split', action='store_true', help='send files larger than max size in parts')
+    parser.add_argument('--thumbnails', default='datauri', choices=THUMBNAIL_MODES)
+    parser.add_argument('--text-format', default='json', choices=TEXT_FORMATS)
+    parser.add_argument('--meta-workers', type=int, default=os.cpu_count(), help='meta data workers')
+    parser.add_argument('--workers', type=int, default=4, help='messages sent at a time')
+    parser.add_argument('--streaming', action='store_true', help='stream each message to the server')
+    parser.add_argument('--accounts', metavar='FILE',
+                        help='JSON list of SMTPAccount arguments to share the messages among, '
+                             'with "smtp": "HOST[:PORT]" and "password_env": VAR, eg: '
+                             '[{"smtp": "smtp.abc.com:587", "user_name": "xxx", "password_env": "PW1", '
+                             '"max_messages": 500, "concurrency": 2}, ...]')
+    parser.add_argument('--fanout', type=int, metavar='N',
+                        help='send each batch of N recipients its own message, the body is built once')
+    parser.add_argument('--cache', help='MetaDataCache file')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the meta data as MetaRecord and the thumbnails in a temporary file')
+    parser.add_argument('--journal', help='SendJournal file, sent groups are skipped when rerun')
+    parser.add_argument('--sent-index', help='SentIndex file, files already sent are skipped')
+    parser.add_argument('--dedupe', action='store_true', help='skip files with the same content')
+    parser.add_argument('--metrics', help='write the metrics to this file, Prometheus text if it ends with .prom')
+    parser.add_argument('--dry-run', action='store_true', help='print the groups instead of sending')
+    args = parser.parse_args(argv)
+    
+    def host_port(arg):
+        host, _, port = arg.rpartition(':') if ':' in arg else (arg, None, None)
+        return (host, int(port) if port else 25)
+    
+    smtp = None
+    if args.smtp is not None:
+        smtp = host_port(args.smtp)
+    accounts = None
+    if args.accounts is not None:
+        with open(args.accounts) as f:
+            accounts = json.load(f)
+        for x in accounts:
+            if isinstance(x['smtp'], str):
+                x['smtp'] = host_port(x['smtp'])
+            if 'from' in x:
+                x['from_'] = x.pop('from')
+            if 'password_env' in x:
+                x['password'] = os.environ[x.pop('password_env')]
+        accounts = AccountScheduler(accounts)
+        # keep every account busy
+        args.workers = max(args.workers, sum(x.concurrency for x in accounts.accounts))
+    password = None
+    if not args.no_auth and not args.dry_run and accounts is None:
+        password = (os.environ[args.password_env] if args.password_env
+                    else getpass.getpass('password of %s: ' % (args.user or args.from_)))
+    
+    metrics = Metrics() if args.metrics else None
+    estimator = WireSizeEstimator(thumbnails=args.thumbnails, text_format=args.text_format) if args.estimate else None
+    max_size = int(args.max_size * 1024 * 1024)
+    opened = []
+    def open_db(cls, path):
+        if path is None:
+            return None
+        db = cls(path)
+        opened.append(db)
+        return db
+    
+    try:
+        cache = open_db(MetaDataCache, args.cache)
+        compact = open_db(ThumbnailSpool, tempfile.gettempdir()) if args.compact else False
+        kwd = dict(
+            from_=args.from_, to=args.to or [args.from_], cc=args.cc, bcc=args.bcc, smtp=smtp, mode=args.mode,
+            user_name=args.user, password=password, title=args.title, thumbnails=args.thumbnails,
+            text_format=args.text_format, workers=args.workers, streaming=args.streaming, fanout=args.fanout,
+            accounts=accounts, journal=open_db(SendJournal, args.journal), metrics=metrics,
+            on_result=lambda x: print('%s: %s' % (x['email'].subject, 'ok' if x['ok'] else
+                                                  x['result'] if x['error'] is None else repr(x['error']))),
+        )
+        sent_index = open_db(SentIndex, args.sent_index)
+        recipients = kwd['to'] + kwd['cc'] + kwd['bcc']
         
+        if args.ordered_by or args.dry_run:
+            groups = files2groups(iter_files(args.paths, args.include, args.exclude, not args.no_recursive),
+                                  max_size, args.ordered_by, estimator, split=args.split, workers=args.meta_workers,
+                                  cache=cache, sent_index=sent_index, recipients=recipients, dedupe=args.dedupe,
+                                  metrics=metrics, compact=compact)
+            if args.dry_run:
+                for subject, grp in zip(groups2subjects(groups, args.title), groups):
+                    print(subject)
+                    for x in grp:
+                        print('    %s' % x['file']['name'])
+            else:
+                results = send_groups(groups, sent_index=sent_index, **kwd)
+        else:
+            results = send_pipeline(args.paths, max_size, args.include, args.exclude, not args.no_recursive,
+                                    args.meta_workers, cache=cache, estimator=estimator, split=args.split,
+                                    sent_index=sent_index, dedupe=args.dedupe, compact=compact, **kwd)
+    finally:
+        for db in opened:
+            db.close()
+    
+    if accounts is not None:
+        for name, x in accounts.report().items():
+            print('%s: %d messages, %s%s' % (name, x['messages'], sizeof_fmt(x['bytes']),
+                                             ', disabled by %s' % x['disabled'] if x['disabled'] else ''))
+    if metrics is not None:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.to_prometheus() if args.metrics.endswith('.prom') else metrics.to_json(indent=4))
+    if not args.dry_run and not all(x['ok'] for x in results):
+        return 1
+    return 0
+
 
 if __name__ == '__main__':
-    # sort and split images into groups
-    grps = files2groups(glob('*.JPG')+['batchmail.py'], max_size=10*1024*1024, ordered_by='image.date')
-    # setup each Email instance
-    emls = groups2Emails(grps, title='Some photos')
-    for eml in emls:
-        eml.from_ = 'xxx@example.com'
-        eml.to = ['yyy@abc.com']
-        eml.user_name = 'xxx@example.com'
-        eml.password = '*********'
-        eml.smtp = 'smtp.example.com'
-        
-#         eml.send()
-         
-        eml.normalize()
-        print(eml)
+    sys.exit(main())
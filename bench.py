@@ -0,0 +1,304 @@
+"""benchmark of batchmail on a synthetic corpus
+
+the corpus (tiny files, large binaries and JPEGs with EXIF) is generated in a
+temporary directory, each stage of the pipeline is timed and the emails are
+sent to an in-process SMTP sink, no network is needed.
+
+usage:
+python bench.py
+python bench.py --tiny 5000 --large 2 --large-size 100 --jpegs 640x480:50,4000x3000:10 --json bench.json
+python bench.py --corpus /tmp/corpus --keep       # reuse the corpus between runs
+
+the JSON report has the seconds, files/s and MB/s of each stage, keep the
+reports of each version to track the throughput.
+"""
+import os, sys, time, json, random, tempfile, shutil, argparse, platform, socketserver, threading
+
+import batchmail
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """in-process SMTP server discarding the messages, counting them
+
+    speaks enough ESMTP for smtplib: EHLO/HELO, AUTH (any credentials), MAIL,
+    RCPT, DATA, BDAT if chunking, RSET, NOOP and QUIT.
+
+    usage:
+    with SMTPSink() as sink:
+        emls = groups2Emails(grps, ..., smtp=('127.0.0.1', sink.port), mode='normal')
+        # the smtp events come from the SMTPPool of send_emails()
+        send_emails(emls, metrics=metrics)
+        print(sink.messages, sink.bytes)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, chunking=True):
+        self.chunking = chunking
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        super().__init__((host, port), SMTPSinkHandler)
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def count(self, nbytes):
+        with self.lock:
+            self.messages += 1
+            self.bytes += nbytes
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        write = self.wfile.write
+        write(b'220 batchmail bench sink\r\n')
+        # bytes of the message so far sent by BDAT
+        bdat_bytes = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.strip().split()
+            verb = cmd[0].upper() if cmd else b''
+            if verb == b'EHLO':
+                write(b'250-sink\r\n250-8BITMIME\r\n250-AUTH PLAIN LOGIN\r\n' +
+                      (b'250-CHUNKING\r\n' if server.chunking else b'') + b'250 SIZE 0\r\n')
+            elif verb == b'AUTH':
+                write(b'235 ok\r\n')
+            elif verb == b'DATA':
+                write(b'354 go ahead\r\n')
+                nbytes = 0
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    nbytes += len(line)
+                server.count(nbytes)
+                write(b'250 ok queued\r\n')
+            elif verb == b'BDAT':
+                left = int(cmd[1])
+                while left:
+                    got = len(self.rfile.read(min(left, 1024*1024)))
+                    if not got:
+                        return
+                    left -= got
+                    bdat_bytes += got
+                if len(cmd) > 2:
+                    server.count(bdat_bytes)
+                    bdat_bytes = 0
+                    write(b'250 ok queued\r\n')
+                else:
+                    write(b'250 ok\r\n')
+            elif verb == b'QUIT':
+                write(b'221 bye\r\n')
+                return
+            else:
+                write(b'250 ok\r\n')
+
+
+def make_jpeg(path, width, height, date, device, quality=90):
+    """write a noisy JPEG with EXIF date and device, return False without PIL"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return False
+    # noise compresses like a photo, a flat image would be unrealistically small
+    im = Image.effect_noise((width, height), 48).convert('RGB')
+    exif = Image.Exif()
+    exif[0x0110] = device       # Model
+    exif[0x0132] = date         # DateTime
+    exif[0x010f] = 'batchmail'  # Make
+    # DateTimeOriginal, in the Exif IFD, is the date read by probe_image()
+    exif.get_ifd(0x8769)[0x9003] = date
+    im.save(path, 'JPEG', quality=quality, exif=exif)
+    return True
+
+def make_corpus(out_dir, tiny=1000, tiny_size=512, large=2, large_size=20*1024*1024,
+                jpegs=((640, 480, 20), (4000, 3000, 5)), seed=0):
+    """generate a synthetic corpus in out_dir, return the list of file names
+
+    tiny: number of tiny files of random sizes up to tiny_size.
+    large: number of large binaries of large_size bytes.
+    jpegs: (width, height, count) of JPEGs with EXIF, skipped without PIL.
+    existing files are kept, so a corpus can be reused.
+    """
+    rnd = random.Random(seed)
+    files = []
+    def make(name, data_func):
+        path = os.path.join(out_dir, name)
+        if not os.path.exists(path):
+            data_func(path)
+        files.append(path)
+
+    os.makedirs(out_dir, exist_ok=True)
+    for i in range(tiny):
+        size = rnd.randint(1, tiny_size)
+        def write_tiny(path, size=size):
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+        make('tiny%06d.bin' % i, write_tiny)
+
+    for i in range(large):
+        def write_large(path):
+            with open(path, 'wb') as f:
+                left = large_size
+                while left:
+                    n = min(left, batchmail.HASH_CHUNK_SIZE)
+                    f.write(os.urandom(n))
+                    left -= n
+        make('large%03d.bin' % i, write_large)
+
+    for width, height, count in jpegs:
+        for i in range(count):
+            date = '20%02d:%02d:%02d %02d:%02d:%02d' % (rnd.randint(0, 25), rnd.randint(1, 12), rnd.randint(1, 28),
+                                                        rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+            path = os.path.join(out_dir, 'img%dx%d_%04d.jpg' % (width, height, i))
+            if os.path.exists(path) or make_jpeg(path, width, height, date, 'Cam %d' % (i % 3)):
+                files.append(path)
+    return files
+
+
+class Timer:
+    """collect the seconds, items and bytes of each stage"""
+    def __init__(self):
+        self.stages = []
+
+    def __call__(self, name, func, items=0, nbytes=0):
+        t0 = time.perf_counter()
+        ret = func()
+        seconds = time.perf_counter() - t0
+        self.stages.append({
+            'stage'     : name,
+            'seconds'   : seconds,
+            'items'     : items,
+            'bytes'     : nbytes,
+            'items_per_sec' : items / seconds if seconds else None,
+            'mb_per_sec'    : nbytes / seconds / 1e6 if seconds else None,
+        })
+        return ret
+
+    def report(self, out=sys.stdout):
+        out.write('%-16s %10s %10s %12s %10s\n' % ('stage', 'seconds', 'items', 'items/s', 'MB/s'))
+        for x in self.stages:
+            out.write('%-16s %10.3f %10d %12s %10s\n' % (
+                x['stage'], x['seconds'], x['items'],
+                '%.1f' % x['items_per_sec'] if x['items_per_sec'] else '-',
+                '%.1f' % x['mb_per_sec'] if x['mb_per_sec'] else '-'))
+
+
+def run(files, max_size=10*1024*1024, workers=None, pool='process', ordered_by='image.date',
+        thumbnails='datauri', streaming=False, send_workers=4, chunking=True, cache=None):
+    """time each stage on files, return the Timer and the batchmail.Metrics"""
+    timer = Timer()
+    metrics = batchmail.Metrics()
+    total = sum(os.path.getsize(x) for x in files)
+
+    meta_data = timer('get_meta_data', lambda: batchmail.files2meta_data_list(
+        files, workers=workers, pool=pool, cache=cache, metrics=metrics), len(files), total)
+    meta_data = timer('sort', lambda: batchmail.sort_meta_data_list(meta_data, ordered_by), len(meta_data))
+    estimator = batchmail.WireSizeEstimator(thumbnails=thumbnails)
+    groups = timer('group', lambda: batchmail.meta_data2groups(
+        meta_data, max_size, estimator=estimator, split=True, metrics=metrics), len(meta_data), total)
+    timer('group2html', lambda: [ batchmail.group2html(grp, thumbnails, []) for grp in groups ],
+          len(groups))
+    timer('group2text', lambda: [ batchmail.group2text(grp) for grp in groups ], len(groups))
+
+    with SMTPSink(chunking=chunking) as sink:
+        emails = batchmail.groups2Emails(groups, title='bench', thumbnails=thumbnails,
+                                         from_='bench@example.com', to=['sink@example.com'],
+                                         smtp=('127.0.0.1', sink.port), mode='normal', metrics=metrics)
+        if not streaming:
+            payloads = timer('Email.generate', lambda: [ eml.generate() for eml in emails ],
+                             len(emails), total)
+            nbytes = sum(len(x) for x in payloads)
+            del payloads
+        else:
+            nbytes = sum(len(x) for eml in emails for x in eml.iter_payload())
+        results = timer('send', lambda: batchmail.send_emails(emails, workers=send_workers, streaming=streaming,
+                                                             metrics=metrics),
+                        len(emails), nbytes)
+        failed = [ x for x in results if not x['ok'] ]
+        if failed:
+            raise Exception('%d of %d messages failed: %r\n' % (len(failed), len(results), failed[0]['result']))
+        timer.stages[-1]['sink'] = { 'messages': sink.messages, 'bytes': sink.bytes,
+                                     'connections': sink.connections }
+    return timer, metrics
+
+
+def parse_jpegs(arg):
+    ret = []
+    for x in arg.split(','):
+        if x:
+            size, count = x.split(':')
+            width, height = size.split('x')
+            ret.append((int(width), int(height), int(count)))
+    return ret
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark batchmail on a synthetic corpus')
+    parser.add_argument('--corpus', help='directory of the corpus, a temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='keep the corpus')
+    parser.add_argument('--tiny', type=int, default=1000, help='number of tiny files')
+    parser.add_argument('--tiny-size', type=int, default=512, help='max size of tiny files in bytes')
+    parser.add_argument('--large', type=int, default=2, help='number of large binaries')
+    parser.add_argument('--large-size', type=float, default=20, help='size of large binaries in MiB')
+    parser.add_argument('--jpegs', type=parse_jpegs, default='640x480:20,4000x3000:5',
+                        help='JPEGs with EXIF as WIDTHxHEIGHT:COUNT,...')
+    parser.add_argument('--max-size', type=float, default=10, help='max email size in MiB')
+    parser.add_argument('--workers', type=int, help='workers of get_meta_data')
+    parser.add_argument('--pool', default='process', choices=('process', 'thread'))
+    parser.add_argument('--thumbnails', default='datauri', choices=batchmail.THUMBNAIL_MODES)
+    parser.add_argument('--streaming', action='store_true', help='stream the emails instead of generate()')
+    parser.add_argument('--send-workers', type=int, default=4)
+    parser.add_argument('--no-chunking', action='store_true', help='sink without BDAT, DATA is used')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args(argv)
+
+    corpus = args.corpus or tempfile.mkdtemp(prefix='batchmail-bench-')
+    try:
+        t0 = time.perf_counter()
+        files = make_corpus(corpus, args.tiny, args.tiny_size, args.large, int(args.large_size*1024*1024),
+                            args.jpegs)
+        sys.stdout.write('corpus: %d files, %s in %s (%.1fs)\n' % (
+            len(files), batchmail.sizeof_fmt(sum(os.path.getsize(x) for x in files)), corpus,
+            time.perf_counter() - t0))
+        timer, metrics = run(files, int(args.max_size*1024*1024), args.workers, args.pool, thumbnails=args.thumbnails,
+                             streaming=args.streaming, send_workers=args.send_workers,
+                             chunking=not args.no_chunking)
+        timer.report()
+        counters = metrics.snapshot()
+        sys.stdout.write('get_meta_data: read %.3fs, hash %.3fs, magic %.3fs, image %.3fs (summed over workers)\n' % tuple(
+            counters.get('file', {}).get(x, 0) for x in ('read_time', 'hash_time', 'magic_time', 'image_time')))
+    finally:
+        if not args.keep and not args.corpus:
+            shutil.rmtree(corpus, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'time'      : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python'    : platform.python_version(),
+                'platform'  : platform.platform(),
+                'args'      : { k: v for k, v in vars(args).items() if k != 'json' },
+                'files'     : len(files),
+                'stages'    : timer.stages,
+                'metrics'   : metrics.snapshot(),
+            }, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()